@@ -1,5 +1,25 @@
-import firebase_admin
-from firebase_admin import messaging
+import asyncio
+import time
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+from app.services.notification_service import invalid_token_errors, prune_tokens
+
+messaging = lazy_import("firebase_admin.messaging")
+firestore = lazy_import("firebase_admin.firestore")
+
+# FCM multicast limit
+MULTICAST_CHUNK = 500
+
+# Segment type -> user document field it filters on
+SEGMENT_FIELDS = {
+    'nutritionist': 'parent_id',
+    'role': 'role',
+}
 
 def broadcast_message(title: str, body: str, data: dict = None):
     """
@@ -23,4 +43,113 @@ def broadcast_message(title: str, body: str, data: dict = None):
         return response
     except Exception as e:
         print('Error sending message:', e)
-        raise e
\ No newline at end of file
+        raise e
+
+def _fetch_token_page(segment_type: str, segment_value: str, cursor, page_size: int):
+    """
+    Returns (tokens, next_cursor) for one page of users in the segment.
+    Only users/{uid}.fcm_tokens is read (see notification_service.register_token);
+    next_cursor is None on the last page.
+    """
+    db = firestore.client()
+    query = db.collection('users').where(SEGMENT_FIELDS[segment_type], '==', segment_value)
+    query = query.select(['fcm_tokens']).order_by('__name__').limit(page_size)
+    if cursor is not None:
+        query = query.start_after(cursor)
+
+    docs = list(query.stream())
+    tokens = []
+    for doc in docs:
+        tokens.extend(t for t in (doc.to_dict() or {}).get('fcm_tokens') or [] if t)
+    next_cursor = docs[-1] if len(docs) == page_size else None
+    return tokens, next_cursor
+
+def _send_multicast(tokens: list[str], title: str, body: str, data: dict):
+    message = messaging.MulticastMessage(
+        notification=messaging.Notification(title=title, body=body),
+        data=data or {},
+        tokens=tokens,
+    )
+    return messaging.send_each_for_multicast(message)
+
+async def _send_chunk(semaphore: asyncio.Semaphore, tokens: list[str], title: str, body: str, data: dict, report: dict):
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            response = await run_in_threadpool(_send_multicast, tokens, title, body, data)
+        except Exception as e:
+            print('Error sending broadcast chunk:', e)
+            report['failed'] += len(tokens)
+            return
+        finally:
+            metrics.observe("broadcast.chunk_latency", time.perf_counter() - started)
+
+    report['sent'] += response.success_count
+    report['failed'] += response.failure_count
+    dead_tokens = [
+        token for token, result in zip(tokens, response.responses)
+        if not result.success and isinstance(result.exception, invalid_token_errors())
+    ]
+    if dead_tokens:
+        report['pruned'] += len(dead_tokens)
+        await run_in_threadpool(prune_tokens, dead_tokens)
+
+async def run_segment_broadcast(job_id: str, title: str, body: str, data: Optional[dict], segment_type: str, segment_value: Optional[str]):
+    """
+    Background job: resolves device tokens page by page and fans them out in
+    concurrent multicast chunks. Progress and the final delivery report are
+    written to broadcast_reports/{job_id}.
+    """
+    db = firestore.client()
+    report_ref = db.collection('broadcast_reports').document(job_id)
+    report = {'targeted': 0, 'sent': 0, 'failed': 0, 'pruned': 0, 'chunks': 0}
+
+    try:
+        if segment_type == 'all':
+            # Every app instance is subscribed to the topic: a single send covers everyone
+            await run_in_threadpool(broadcast_message, title, body, data)
+            report['chunks'] = 1
+        else:
+            semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+            tasks, pending, seen = [], [], set()
+            cursor = None
+            while True:
+                tokens, cursor = await run_in_threadpool(
+                    _fetch_token_page, segment_type, segment_value, cursor, settings.BROADCAST_PAGE_SIZE
+                )
+                for token in tokens:
+                    if token not in seen:
+                        seen.add(token)
+                        pending.append(token)
+                while len(pending) >= MULTICAST_CHUNK or (cursor is None and pending):
+                    chunk, pending = pending[:MULTICAST_CHUNK], pending[MULTICAST_CHUNK:]
+                    report['chunks'] += 1
+                    tasks.append(asyncio.create_task(_send_chunk(semaphore, chunk, title, body, data, report)))
+                if cursor is None:
+                    break
+            report['targeted'] = len(seen)
+            await asyncio.gather(*tasks)
+            if not seen:
+                raise RuntimeError("No registered device tokens in this segment")
+
+        report_ref.set({**report, 'status': 'completed', 'completed_at': firestore.SERVER_TIMESTAMP}, merge=True)
+        print(f"Broadcast {job_id} completed: {report}")
+    except Exception as e:
+        print(f"Broadcast {job_id} failed: {e}")
+        report_ref.set({**report, 'status': 'failed', 'error': str(e), 'completed_at': firestore.SERVER_TIMESTAMP}, merge=True)
+    finally:
+        metrics.incr("broadcast.sent", report['sent'])
+        metrics.incr("broadcast.failed", report['failed'])
+
+def create_broadcast_report(title: str, segment_type: str, segment_value: Optional[str], created_by: str) -> str:
+    """Creates the report document for a new broadcast job and returns its id."""
+    report_ref = firestore.client().collection('broadcast_reports').document()
+    report_ref.set({
+        'title': title,
+        'segment_type': segment_type,
+        'segment_value': segment_value,
+        'status': 'running',
+        'created_by': created_by,
+        'created_at': firestore.SERVER_TIMESTAMP,
+    })
+    return report_ref.id
@@ -6,6 +6,15 @@ class Settings(BaseSettings):
     # Loads from .env automatically
     GOOGLE_API_KEY: str = ""
     GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    # Cheaper/faster tier for small documents, see services/model_router.py
+    GEMINI_MODEL_SMALL: str = "gemini-2.5-flash-lite"
+    # Model used when the routed model's output fails schema validation ("large" = GEMINI_MODEL)
+    GEMINI_ESCALATION_MODEL: str = "large"
+    # First matching rule wins; JSON list when set through the environment
+    GEMINI_ROUTING_RULES: list[dict] = [
+        {"kind": "receipt", "max_chars": 4000, "model": "small"},
+        {"kind": "diet", "max_chars": 12000, "max_pages": 4, "has_substitutions": False, "has_custom_prompt": False, "model": "small"},
+    ]
     
     # [SECURITY FIX] Strict CORS Policy
     # Add your Flutter Web production domain here
@@ -25,6 +34,71 @@ class Settings(BaseSettings):
     RECEIPT_PATH_PREFIX: str = "temp_scontrino"
     DIET_JSON_PATH: str = "dieta.json"
 
+    # Uploads are spooled in memory up to this size, then spill to UPLOAD_SPOOL_DIR
+    # (defaults to the system temp dir; point it at a tmpfs only if it is sized for it)
+    UPLOAD_SPOOL_MAX_MEMORY: int = 4 * 1024 * 1024
+    UPLOAD_SPOOL_DIR: str = ""
+
+    # Diet PDF extraction stops once either budget is exceeded (0 disables a budget)
+    DIET_TEXT_CHAR_BUDGET: int = 400_000
+    DIET_TEXT_TOKEN_BUDGET: int = 0
+
+    # Incremental re-parse: above this share of changed pages the whole diet is re-parsed
+    DIET_INCREMENTAL_MAX_CHANGED_RATIO: float = 0.5
+
+    # Compact plan storage (services/plan_codec.py). Off until the apps read `compactPlan`:
+    # when on, diet docs store it in place of parsedData / plan + substitutions
+    COMPACT_PLAN_STORAGE: bool = False
+    COMPACT_PLAN_COMPRESSION: bool = True
+    COMPACT_PLAN_COMPRESS_MIN_BYTES: int = 16 * 1024
+
+    # Receipt OCR
+    # Pages whose embedded text layer yields fewer chars than this are rasterized and OCR'd
+    RECEIPT_TEXT_LAYER_MIN_CHARS: int = 20
+    RECEIPT_OCR_DPI: int = 300
+    RECEIPT_OCR_WORKERS: int = 4
+
+    # Bulk diet uploads
+    BULK_UPLOAD_MAX_ITEMS: int = 50
+    BULK_PARSE_CONCURRENCY: int = 4
+
+    # Bulk user import (/admin/import-users)
+    USER_IMPORT_MAX_ROWS: int = 2000
+    USER_IMPORT_CONCURRENCY: int = 8
+    # PBKDF2-SHA256 rounds for imported passwords; Firebase re-hashes them at first sign-in
+    USER_IMPORT_HASH_ROUNDS: int = 10_000
+
+    # Segmented broadcasts: users read per Firestore page, concurrent multicast chunks
+    BROADCAST_PAGE_SIZE: int = 500
+    BROADCAST_CONCURRENCY: int = 4
+
+    # Gemini resilience (services/gemini_gateway.py)
+    GEMINI_DIET_TIMEOUT_SECONDS: float = 120.0
+    GEMINI_RECEIPT_TIMEOUT_SECONDS: float = 30.0
+    GEMINI_MAX_RETRIES: int = 1
+    GEMINI_RETRY_BACKOFF_SECONDS: float = 1.0
+    GEMINI_HEDGE_ENABLED: bool = False
+    GEMINI_HEDGE_MIN_DELAY_SECONDS: float = 5.0
+    GEMINI_BREAKER_WINDOW: int = 20
+    GEMINI_BREAKER_ERROR_RATE: float = 0.5
+    GEMINI_BREAKER_MIN_CALLS: int = 5
+    GEMINI_BREAKER_COOLDOWN_SECONDS: float = 30.0
+    GEMINI_MAX_WORKERS: int = 16
+    GEMINI_RESPONSE_CACHE_SIZE: int = 128
+
+    # Provider-side context caching of long system prompts (services/context_cache.py)
+    CONTEXT_CACHE_ENABLED: bool = True
+    CONTEXT_CACHE_STORE: str = "memory"  # "memory" | "firestore"
+    CONTEXT_CACHE_TIMEOUT_SECONDS: float = 10.0
+    CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    CONTEXT_CACHE_REFRESH_MARGIN_SECONDS: int = 300
+    # Below the provider's minimum cacheable size the prompt is sent inline (~4 chars/token)
+    CONTEXT_CACHE_MIN_CHARS: int = 8000
+
+    # Cold starts: heavy modules and the Gemini client load on first use; set to
+    # pay that cost in the background right after startup instead
+    WARMUP_ON_STARTUP: bool = False
+
     # Keywords
     MEAL_MAPPING: dict = {
         "prima colazione": "Colazione",
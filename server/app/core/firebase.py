@@ -0,0 +1,48 @@
+import os
+import threading
+import time
+
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+
+# Imported by the first init_firebase() call, not when this module loads
+firebase_admin = lazy_import("firebase_admin")
+credentials = lazy_import("firebase_admin.credentials")
+
+SERVICE_ACCOUNT_PATH = "serviceAccountKey.json"
+FIRESTORE_BATCH_LIMIT = 500  # writes per batch
+
+_lock = threading.Lock()
+
+
+def init_firebase() -> bool:
+    """
+    Initializes the default Firebase app once per process, from
+    GOOGLE_APPLICATION_CREDENTIALS or serviceAccountKey.json.
+    Returns False when no credentials are available.
+    """
+    if firebase_admin._apps:
+        return True
+    with _lock:
+        if firebase_admin._apps:
+            return True
+        started = time.perf_counter()
+        try:
+            if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+                firebase_admin.initialize_app(credentials.ApplicationDefault())
+            elif os.path.exists(SERVICE_ACCOUNT_PATH):
+                firebase_admin.initialize_app(credentials.Certificate(SERVICE_ACCOUNT_PATH))
+            else:
+                print("⚠️ Firebase credentials not found. Firestore, Auth and notifications disabled.")
+                return False
+        except Exception as e:
+            print(f"⚠️ Firebase Init Error: {e}")
+            return False
+        metrics.set_gauge("startup.firebase_init_seconds", round(time.perf_counter() - started, 4))
+        print("🔥 Firebase Admin Initialized")
+        return True
+
+
+def firebase_ready() -> bool:
+    """True once the default app exists; never triggers the firebase_admin import itself."""
+    return firebase_admin.loaded and bool(firebase_admin._apps)
@@ -0,0 +1,89 @@
+import importlib
+import threading
+import time
+from typing import Callable
+
+from app.core.metrics import metrics
+
+_registry: list["LazyModule"] = []
+_import_times: dict[str, float] = {}
+
+
+class LazyModule:
+    """
+    Stand-in for a heavy module: the real import happens on first attribute
+    access and its duration is recorded as the `import.<name>.seconds` gauge.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    elapsed = time.perf_counter() - started
+                    _import_times[self._name] = elapsed
+                    metrics.set_gauge(f"import.{self._name}.seconds", round(elapsed, 4))
+                    self._module = module
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value) -> None:
+        # Own state is underscored; anything else (e.g. PIL's MAX_IMAGE_PIXELS) belongs to the module
+        if attr.startswith("_"):
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._load(), attr, value)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self._name}' ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    module = LazyModule(name)
+    _registry.append(module)
+    return module
+
+
+def load_all() -> None:
+    """Imports every registered lazy module now (warm-up)."""
+    for module in _registry:
+        try:
+            module._load()
+        except ImportError as e:
+            print(f"⚠️ Warm-up import failed for {module._name}: {e}")
+
+
+def import_report() -> dict:
+    """Seconds spent importing each lazy module so far; None for modules not loaded yet."""
+    return {module._name: _import_times.get(module._name) for module in _registry}
+
+
+class LazyObject:
+    """Builds `factory()` on first attribute access (e.g. service singletons holding API clients)."""
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, attr: str):
+        return getattr(self.get(), attr)
@@ -0,0 +1,62 @@
+import threading
+from collections import defaultdict, deque
+
+
+class Metrics:
+    """
+    Process-local counters, gauges and latency samples.
+    Exposed as a snapshot by GET /admin/metrics.
+    """
+
+    def __init__(self, max_samples: int = 1000):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def set_gauge(self, name: str, value) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._timings[name].append(seconds)
+
+    def count(self, name: str) -> int:
+        """Number of retained samples for a timing."""
+        with self._lock:
+            return len(self._timings.get(name, ()))
+
+    def percentile(self, name: str, q: float):
+        """Returns the q-th percentile (0-100) of a timing, or None without samples."""
+        with self._lock:
+            samples = sorted(self._timings.get(name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            timings = {name: sorted(samples) for name, samples in self._timings.items() if samples}
+            result = {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+            }
+        result["timings"] = {
+            name: {
+                "count": len(samples),
+                "p50": samples[len(samples) // 2],
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "max": samples[-1],
+            }
+            for name, samples in timings.items()
+        }
+        return result
+
+
+metrics = Metrics()
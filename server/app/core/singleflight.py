@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Optional
+
+from app.core.metrics import metrics
+
+
+def flight_key(*parts: Optional[str]) -> str:
+    """Stable key from content hash, prompt, etc. (None and "" are equivalent)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key starts the
+    computation, later callers with the same key await the same result.
+    The computation runs as its own task, so a disconnecting caller does not
+    cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is not None:
+            metrics.incr(f"singleflight.{self.name}.coalesced")
+        else:
+            metrics.incr(f"singleflight.{self.name}.executed")
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
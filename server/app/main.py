@@ -1,32 +1,45 @@
 import os
-import uuid
+import time
+
+# Cold-start profiling: how long importing this module takes (see startup report)
+_IMPORT_STARTED = time.perf_counter()
+
 import structlog
-import aiofiles
 import json
 import asyncio
 from datetime import datetime, timezone
 from typing import Optional, List, Dict
 
-import firebase_admin
-from firebase_admin import credentials, auth, firestore, messaging
-
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Header, Depends, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Header, Depends, Request, BackgroundTasks, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from pydantic import Json, BaseModel
+from pydantic import Json, BaseModel, Field, ValidationError
 
 # --- IMPORTS ---
 from app.services.diet_service import DietParser
 from app.services.receipt_service import ReceiptScanner
-from app.services.notification_service import NotificationService
+from app.services.notification_service import NotificationDispatcher, register_token
+from app.services.upload_service import spool_upload_file
+from app.services.gemini_gateway import GeminiUnavailableError
 from app.services.normalization import normalize_meal_name
+from app.services.plan_codec import encode_plan, diet_summary_counts, DIET_SUMMARY_COLLECTION, DIET_SUMMARY_FIELDS
+from app.services.user_import_service import parse_users_csv, import_users
 from app.core.config import settings
+from app.core.firebase import init_firebase
+from app.core.lazy import lazy_import, LazyObject, load_all, import_report
+from app.core.metrics import metrics
+from app.core.singleflight import SingleFlight, flight_key
 from app.models.schemas import DietResponse, Dish, Ingredient, SubstitutionGroup, SubstitutionOption
-from app.broadcast import broadcast_message 
+from app.broadcast import create_broadcast_report, run_segment_broadcast
+
+# Loaded on first use to keep cold starts fast (see core/lazy.py)
+auth = lazy_import("firebase_admin.auth")
+firestore = lazy_import("firebase_admin.firestore")
 
 # --- CONFIGURATION ---
 MAX_FILE_SIZE = 10 * 1024 * 1024
@@ -46,25 +59,15 @@ structlog.configure(
 )
 logger = structlog.get_logger()
 
-# --- FIREBASE INIT ---
-if not firebase_admin._apps:
-    try:
-        if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-            cred = credentials.ApplicationDefault()
-            firebase_admin.initialize_app(cred)
-        elif os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-        else:
-            logger.warning("firebase_init_fail", reason="no_credentials")
-    except Exception as e:
-        logger.error("firebase_init_critical_error", error=str(e))
-
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI()
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+@app.exception_handler(GeminiUnavailableError)
+async def gemini_unavailable_handler(request: Request, exc: GeminiUnavailableError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(int(settings.GEMINI_BREAKER_COOLDOWN_SECONDS))})
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.ALLOWED_ORIGINS,
@@ -73,8 +76,11 @@ app.add_middleware(
     allow_headers=["Authorization", "Content-Type"],
 )
 
-notification_service = NotificationService()
-diet_parser = DietParser()
+notification_dispatcher = NotificationDispatcher()
+diet_flights = SingleFlight("diet_parse")
+receipt_flights = SingleFlight("receipt_scan")
+# Built (with its Gemini client) by the first request that needs it
+diet_parser = LazyObject(DietParser)
 
 # --- SCHEMAS ---
 class CreateUserRequest(BaseModel):
@@ -105,25 +111,50 @@ class ScheduleMaintenanceRequest(BaseModel):
     scheduled_time: str
     message: str
     notify: bool
+
+class BroadcastRequest(BaseModel):
+    title: str
+    body: str
+    data: Optional[Dict[str, str]] = None
+    # 'all' (topic) | 'nutritionist' (value = nutritionist uid) | 'role'
+    segment_type: str = Field(default='all', pattern='^(all|nutritionist|role)$')
+    segment_value: Optional[str] = None
+
+class RegisterTokenRequest(BaseModel):
+    fcm_token: str = Field(min_length=1)
+
 class LogAccessRequest(BaseModel):
     target_uid: str
     reason: str
     
 # --- UTILS & SECURITY ---
 
-async def save_upload_file(file: UploadFile, filename: str) -> None:
-    size = 0
+async def _coalesced(flights: SingleFlight, key: str, upload, fn, *args):
+    """
+    Runs fn(*args) in the threadpool, sharing the result with concurrent
+    requests for the same key (same bytes + prompt). Takes ownership of
+    `upload`: it is closed once no computation needs it anymore.
+    """
+    leader = False
+
+    async def run():
+        try:
+            return await run_in_threadpool(fn, *args)
+        finally:
+            upload.close()
+
+    def start():
+        nonlocal leader
+        leader = True
+        return run()
+
     try:
-        async with aiofiles.open(filename, 'wb') as out_file:
-            while content := await file.read(1024 * 1024):
-                size += len(content)
-                if size > MAX_FILE_SIZE:
-                    raise HTTPException(status_code=413, detail="File too large")
-                await out_file.write(content)
-    except Exception as e:
-        if os.path.exists(filename):
-            os.remove(filename)
-        raise e
+        return await flights.do(key, start)
+    finally:
+        # The leader's buffer is closed by the flight itself, which keeps
+        # running for the other callers even if this request goes away
+        if not leader:
+            upload.close()
 
 def validate_extension(filename: str) -> str:
     ext = os.path.splitext(filename)[1].lower()
@@ -145,7 +176,7 @@ async def verify_token(authorization: str = Header(...)):
 
 async def verify_admin(uid: str = Depends(verify_token)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         user_doc = db.collection('users').document(uid).get()
         if not user_doc.exists or user_doc.to_dict().get('role') != 'admin':
             if user_doc.exists and user_doc.to_dict().get('role') == 'nutritionist':
@@ -163,7 +194,7 @@ async def maintenance_worker():
     logger.info("maintenance_worker_started")
     while True:
         try:
-            db = firebase_admin.firestore.client()
+            db = firestore.client()
             doc_ref = db.collection('config').document('global')
             doc = doc_ref.get()
             
@@ -195,9 +226,36 @@ async def maintenance_worker():
         
         await asyncio.sleep(60)
 
+def _warm_up():
+    """Pays the deferred import and client construction costs before traffic needs them."""
+    started = time.perf_counter()
+    load_all()
+    diet_parser.get()
+    firestore.client()
+    metrics.set_gauge("startup.warmup_seconds", round(time.perf_counter() - started, 4))
+    logger.info("startup_warmup_done", seconds=round(time.perf_counter() - started, 3), imports=import_report())
+
+async def warm_up_worker():
+    try:
+        await run_in_threadpool(_warm_up)
+    except Exception as e:
+        logger.error("startup_warmup_failed", error=str(e))
+
 @app.on_event("startup")
 async def start_background_tasks():
+    init_firebase()
     asyncio.create_task(maintenance_worker())
+    notification_dispatcher.start()
+    if settings.WARMUP_ON_STARTUP:
+        asyncio.create_task(warm_up_worker())
+    # Startup profiling report: import cost of this module + lazy modules loaded so far
+    ready_seconds = time.perf_counter() - _IMPORT_STARTED
+    metrics.set_gauge("startup.ready_seconds", round(ready_seconds, 4))
+    logger.info("startup_report", main_import_seconds=round(_main_import_seconds, 3), ready_seconds=round(ready_seconds, 3), imports=import_report())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await notification_dispatcher.stop()
 
 # --- ENDPOINTS ---
 
@@ -205,74 +263,296 @@ async def start_background_tasks():
 @limiter.limit("5/minute")
 async def upload_diet(request: Request, file: UploadFile = File(...), fcm_token: Optional[str] = Form(None), user_id: str = Depends(verify_token)):
     if not file.filename.lower().endswith('.pdf'): raise HTTPException(status_code=400, detail="Only PDF allowed")
-    temp_filename = f"{uuid.uuid4()}.pdf"
+    if fcm_token: await run_in_threadpool(register_token, user_id, fcm_token)
+    upload = await spool_upload_file(file, MAX_FILE_SIZE)
+    key = flight_key("diet", upload.sha256, None)
+    raw_data = await _coalesced(diet_flights, key, upload, diet_parser.parse_complex_diet, upload.open())
+    if fcm_token: notification_dispatcher.enqueue_diet_ready(fcm_token)
+    return _convert_to_app_format(raw_data)
+
+async def _stream_diet_events(upload, custom_prompt: Optional[str], fcm_token: Optional[str], sse: bool):
+    """
+    Runs the streaming parse and emits normalized events: one "day" per completed
+    day, then "substitutions" and "done". A "day" event may be re-sent once the
+    substitution table resolves CAD codes; clients should treat it as an upsert.
+    """
+    def encode(event: dict) -> str:
+        payload = json.dumps(jsonable_encoder(event), ensure_ascii=False)
+        return f"data: {payload}\n\n" if sse else payload + "\n"
+
+    raw_days = []
     try:
-        await save_upload_file(file, temp_filename)
-        raw_data = await run_in_threadpool(diet_parser.parse_complex_diet, temp_filename)
-        if fcm_token: await run_in_threadpool(notification_service.send_diet_ready, fcm_token)
-        return _convert_to_app_format(raw_data)
+        events = diet_parser.parse_complex_diet_stream(upload.open(), custom_prompt)
+        async for kind, value in iterate_in_threadpool(events):
+            if kind == "day":
+                raw_days.append(value)
+                day_name, meals = _convert_day(value, {})
+                yield encode({"type": "day", "day": day_name, "meals": _order_meals(meals)})
+                continue
+
+            cad_map, app_substitutions = _convert_substitutions(value)
+            if cad_map:
+                for raw_day in raw_days:
+                    day_name, meals = _convert_day(raw_day, cad_map)
+                    if meals != _convert_day(raw_day, {})[1]:
+                        yield encode({"type": "day", "day": day_name, "meals": _order_meals(meals)})
+            yield encode({"type": "substitutions", "substitutions": app_substitutions})
+
+        if fcm_token: notification_dispatcher.enqueue_diet_ready(fcm_token)
+        yield encode({"type": "done", "days": len(raw_days)})
+    except Exception as e:
+        logger.error("diet_stream_error", error=str(e))
+        yield encode({"type": "error", "detail": str(e)})
     finally:
-        if os.path.exists(temp_filename): os.remove(temp_filename)
+        upload.close()
 
-@app.post("/upload-diet/{target_uid}", response_model=DietResponse)
-@limiter.limit("10/minute")
-async def upload_diet_admin(request: Request, target_uid: str, file: UploadFile = File(...), fcm_token: Optional[str] = Form(None), requester_id: str = Depends(verify_token)):
+@app.post("/upload-diet-stream")
+@limiter.limit("5/minute")
+async def upload_diet_stream(request: Request, file: UploadFile = File(...), fcm_token: Optional[str] = Form(None), user_id: str = Depends(verify_token)):
+    """
+    Streaming variant of /upload-diet: NDJSON by default, Server-Sent Events
+    when the client sends `Accept: text/event-stream`.
+    """
     if not file.filename.lower().endswith('.pdf'): raise HTTPException(status_code=400, detail="Only PDF allowed")
-    temp_filename = f"{uuid.uuid4()}.pdf"
-    try:
-        await save_upload_file(file, temp_filename)
-        db = firebase_admin.firestore.client()
-        custom_prompt = None
-        user_doc = db.collection('users').document(target_uid).get()
-        if user_doc.exists:
-            parent_id = user_doc.to_dict().get('parent_id')
-            if parent_id:
-                parent_doc = db.collection('users').document(parent_id).get()
-                if parent_doc.exists: custom_prompt = parent_doc.to_dict().get('custom_parser_prompt')
-        
-        raw_data = await run_in_threadpool(diet_parser.parse_complex_diet, temp_filename, custom_prompt)
-        formatted_data = _convert_to_app_format(raw_data)
-        dict_data = formatted_data.dict()
-
+    if fcm_token: await run_in_threadpool(register_token, user_id, fcm_token)
+    upload = await spool_upload_file(file, MAX_FILE_SIZE)
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    return StreamingResponse(
+        _stream_diet_events(upload, None, fcm_token, sse),
+        media_type="text/event-stream" if sse else "application/x-ndjson"
+    )
+
+def _parser_state_ref(db, uid: str):
+    """Page fingerprints + output of the patient's last parse, used for incremental re-parses."""
+    return db.collection('users').document(uid).collection('parser_state').document('latest')
+
+def _diet_upload_writes(db, target_uid: str, file_name: str, dict_data: dict, requester_id: str) -> list:
+    """Returns the (document ref, data) pairs persisted for a nutritionist diet upload."""
+    if settings.COMPACT_PLAN_STORAGE:
+        compact = encode_plan(dict_data)
+        history_plan = {'compactPlan': compact}
+        client_plan = {'compactPlan': compact}
+    else:
+        history_plan = {'parsedData': dict_data}
+        client_plan = {'plan': dict_data.get('plan'), 'substitutions': dict_data.get('substitutions')}
+    history_ref = db.collection('diet_history').document()
+    return [
         # 1. Save to Admin History (Global)
-        db.collection('diet_history').add({
+        (history_ref, {
             'userId': target_uid,
-            'uploadedAt': firebase_admin.firestore.SERVER_TIMESTAMP,
-            'fileName': file.filename,
-            'parsedData': dict_data,
+            'uploadedAt': firestore.SERVER_TIMESTAMP,
+            'fileName': file_name,
+            **history_plan,
             'uploadedBy': requester_id
-        })
-
+        }),
         # 2. Save to Client History (User Subcollection)
-        db.collection('users').document(target_uid).collection('diets').add({
-            'uploadedAt': firebase_admin.firestore.SERVER_TIMESTAMP,
-            'plan': dict_data.get('plan'),
-            'substitutions': dict_data.get('substitutions'),
+        (db.collection('users').document(target_uid).collection('diets').document(), {
+            'uploadedAt': firestore.SERVER_TIMESTAMP,
+            **client_plan,
             'uploadedBy': 'nutritionist'
-        })
-        
-        if fcm_token: await run_in_threadpool(notification_service.send_diet_ready, fcm_token)
-        return formatted_data
+        }),
+        # 3. Lightweight row for list views (same id as the history doc)
+        (db.collection(DIET_SUMMARY_COLLECTION).document(history_ref.id), {
+            'userId': target_uid,
+            'uploadedAt': firestore.SERVER_TIMESTAMP,
+            'fileName': file_name,
+            'uploadedBy': requester_id,
+            **diet_summary_counts(dict_data)
+        }),
+    ]
+
+@app.post("/upload-diet/{target_uid}", response_model=DietResponse)
+@limiter.limit("10/minute")
+async def upload_diet_admin(request: Request, target_uid: str, file: UploadFile = File(...), fcm_token: Optional[str] = Form(None), requester_id: str = Depends(verify_token)):
+    if not file.filename.lower().endswith('.pdf'): raise HTTPException(status_code=400, detail="Only PDF allowed")
+    # The token belongs to the uploader's device, not to the patient
+    if fcm_token: await run_in_threadpool(register_token, requester_id, fcm_token)
+    db = firestore.client()
+    custom_prompt = None
+    user_doc = db.collection('users').document(target_uid).get()
+    if user_doc.exists:
+        parent_id = user_doc.to_dict().get('parent_id')
+        if parent_id:
+            parent_doc = db.collection('users').document(parent_id).get()
+            if parent_doc.exists: custom_prompt = parent_doc.to_dict().get('custom_parser_prompt')
+
+    # Revisions re-extract only the pages that changed since the last upload
+    state_ref = _parser_state_ref(db, target_uid)
+    state_doc = state_ref.get()
+    previous_state = state_doc.to_dict() if state_doc.exists else None
+
+    upload = await spool_upload_file(file, MAX_FILE_SIZE)
+    key = flight_key("diet", upload.sha256, custom_prompt, target_uid)
+    raw_data, parser_state = await _coalesced(
+        diet_flights, key, upload,
+        diet_parser.parse_complex_diet_incremental, upload.open(), custom_prompt, previous_state
+    )
+    formatted_data = _convert_to_app_format(raw_data)
+
+    batch = db.batch()
+    for ref, data in _diet_upload_writes(db, target_uid, file.filename, formatted_data.dict(), requester_id):
+        batch.set(ref, data)
+    batch.set(state_ref, {**parser_state, 'updated_at': firestore.SERVER_TIMESTAMP})
+    batch.commit()
+    
+    if fcm_token: notification_dispatcher.enqueue_diet_ready(fcm_token)
+    return formatted_data
+
+async def _stream_bulk_upload(items: list, requester_id: str, requester_is_nutritionist: bool):
+    """
+    Parses (patient_id, upload) pairs concurrently (BULK_PARSE_CONCURRENCY) and
+    streams NDJSON status lines: "parsed"/"error" as each item finishes, then
+    "saved" once its own Firestore batch is committed, then a summary.
+    """
+    db = firestore.client()
+    semaphore = asyncio.Semaphore(settings.BULK_PARSE_CONCURRENCY)
+    results = {"saved": 0, "error": 0}
+    tasks = []
+
+    def line(event: dict) -> str:
+        return json.dumps(event, ensure_ascii=False) + "\n"
+
+    try:
+        # Resolve every patient and each distinct nutritionist prompt once
+        patient_ids = list({patient_id for patient_id, _ in items})
+        patient_docs = await run_in_threadpool(
+            lambda: {d.id: d for d in db.get_all([db.collection('users').document(u) for u in patient_ids])}
+        )
+        parent_ids = list({d.to_dict().get('parent_id') for d in patient_docs.values() if d.exists and d.to_dict().get('parent_id')})
+        state_docs = await run_in_threadpool(
+            lambda: {d.reference.parent.parent.id: d for d in db.get_all([_parser_state_ref(db, u) for u in patient_ids])}
+        )
+        prompts = {}
+        if parent_ids:
+            parent_docs = await run_in_threadpool(
+                lambda: list(db.get_all([db.collection('users').document(p) for p in parent_ids]))
+            )
+            prompts = {d.id: d.to_dict().get('custom_parser_prompt') for d in parent_docs if d.exists}
+
+        async def process(index: int, patient_id: str, upload):
+            # _coalesced owns the upload once called; until then (rejected, or
+            # cancelled while waiting on the semaphore) it is closed here
+            handed_over = False
+            try:
+                patient_doc = patient_docs.get(patient_id)
+                if patient_doc is None or not patient_doc.exists:
+                    return index, patient_id, upload, None, "Patient not found"
+                parent_id = patient_doc.to_dict().get('parent_id')
+                if requester_is_nutritionist and parent_id != requester_id:
+                    return index, patient_id, upload, None, "Patient not assigned to requester"
+                async with semaphore:
+                    try:
+                        prompt = prompts.get(parent_id)
+                        state_doc = state_docs.get(patient_id)
+                        previous_state = state_doc.to_dict() if state_doc is not None and state_doc.exists else None
+                        handed_over = True
+                        raw_data, parser_state = await _coalesced(
+                            diet_flights, flight_key("diet", upload.sha256, prompt, patient_id), upload,
+                            diet_parser.parse_complex_diet_incremental, upload.open(), prompt, previous_state
+                        )
+                        return index, patient_id, upload, (_convert_to_app_format(raw_data), parser_state), None
+                    except Exception as e:
+                        return index, patient_id, upload, None, str(e)
+            finally:
+                if not handed_over:
+                    upload.close()
+
+        async def save(writes: list) -> Optional[str]:
+            # One batch per item: a plan-sized item can't push a shared commit past
+            # Firestore's request limit, and a failed save stays with its own item
+            batch = db.batch()
+            for ref, data in writes:
+                batch.set(ref, data)
+            try:
+                await run_in_threadpool(batch.commit)
+            except Exception as e:
+                return f"Save failed: {e}"
+            return None
+
+        tasks.extend(asyncio.create_task(process(i, patient_id, upload)) for i, (patient_id, upload) in enumerate(items))
+        for next_done in asyncio.as_completed(tasks):
+            index, patient_id, upload, parsed, error = await next_done
+            if error:
+                results["error"] += 1
+                yield line({"index": index, "patient_id": patient_id, "status": "error", "detail": error})
+                continue
+
+            yield line({"index": index, "patient_id": patient_id, "status": "parsed"})
+            formatted_data, parser_state = parsed
+            writes = _diet_upload_writes(db, patient_id, upload.filename, formatted_data.dict(), requester_id)
+            writes.append((_parser_state_ref(db, patient_id), {**parser_state, 'updated_at': firestore.SERVER_TIMESTAMP}))
+            error = await save(writes)
+            status = "error" if error else "saved"
+            results[status] += 1
+            yield line({"index": index, "patient_id": patient_id, "status": status, "detail": error})
+
+        yield line({"status": "done", "total": len(items), **results})
     finally:
-        if os.path.exists(temp_filename): os.remove(temp_filename)
+        for task in tasks:
+            task.cancel()
+        if not tasks:
+            for _, upload in items:
+                upload.close()
+
+@app.post("/admin/bulk-upload-diets")
+@limiter.limit("2/minute")
+async def bulk_upload_diets(request: Request, files: List[UploadFile] = File(...), patient_ids: Json[List[str]] = Form(...), requester_id: str = Depends(verify_admin)):
+    """
+    Uploads many diets at once: `patient_ids[i]` receives `files[i]`.
+    Responds with an NDJSON stream of per-item status lines.
+    """
+    if len(files) != len(patient_ids):
+        raise HTTPException(status_code=400, detail="files and patient_ids must have the same length")
+    if not files or len(files) > settings.BULK_UPLOAD_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {settings.BULK_UPLOAD_MAX_ITEMS} files allowed")
+    if any(not f.filename.lower().endswith('.pdf') for f in files):
+        raise HTTPException(status_code=400, detail="Only PDF allowed")
+
+    requester_doc = firestore.client().collection('users').document(requester_id).get()
+    requester_is_nutritionist = requester_doc.exists and requester_doc.to_dict().get('role') == 'nutritionist'
+
+    items = []
+    try:
+        for patient_id, f in zip(patient_ids, files):
+            items.append((patient_id, await spool_upload_file(f, MAX_FILE_SIZE)))
+    except Exception:
+        for _, upload in items:
+            upload.close()
+        raise
+
+    return StreamingResponse(
+        _stream_bulk_upload(items, requester_id, requester_is_nutritionist),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/register-fcm-token")
+@limiter.limit("10/minute")
+async def register_fcm_token(request: Request, body: RegisterTokenRequest, user_id: str = Depends(verify_token)):
+    """Registers this device for targeted broadcasts (nutritionist / role segments)."""
+    await run_in_threadpool(register_token, user_id, body.fcm_token)
+    return {"status": "registered"}
 
 @app.post("/scan-receipt")
 async def scan_receipt(request: Request, file: UploadFile = File(...), allowed_foods: Json[List[str]] = Form(...), user_id: str = Depends(verify_token)):
-    temp_filename = f"{uuid.uuid4()}{validate_extension(file.filename)}"
-    try:
-        await save_upload_file(file, temp_filename)
-        current_scanner = ReceiptScanner(allowed_foods_list=allowed_foods)
-        found_items = await run_in_threadpool(current_scanner.scan_receipt, temp_filename)
-        return JSONResponse(content=found_items)
-    finally:
-        if os.path.exists(temp_filename): os.remove(temp_filename)
+    validate_extension(file.filename)
+    current_scanner = ReceiptScanner(allowed_foods_list=allowed_foods)
+    upload = await spool_upload_file(file, MAX_FILE_SIZE)
+    key = flight_key("receipt", upload.sha256, json.dumps(sorted(map(str, allowed_foods))))
+
+    def scan():
+        # The page report travels with the result: followers' scanners never run
+        return current_scanner.scan_receipt(upload.open(), upload.filename), current_scanner.page_report
+
+    found_items, page_report = await _coalesced(receipt_flights, key, upload, scan)
+    logger.info("receipt_scanned", pages=page_report, items=len(found_items))
+    return JSONResponse(content=found_items)
 
 # --- ADMIN USER MANAGEMENT ---
 
 @app.post("/admin/create-user")
 async def admin_create_user(body: CreateUserRequest, requester_id: str = Depends(verify_admin)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         
         # 1. CLEANUP: Delete any existing orphaned docs with this email to prevent duplicates
         existing_docs = db.collection('users').where('email', '==', body.email).stream()
@@ -303,7 +583,7 @@ async def admin_create_user(body: CreateUserRequest, requester_id: str = Depends
             'last_name': body.last_name,
             'parent_id': final_parent_id, 
             'is_active': True,
-            'created_at': firebase_admin.firestore.SERVER_TIMESTAMP,
+            'created_at': firestore.SERVER_TIMESTAMP,
             'created_by': requester_id, 
             'requires_password_change': True
         })
@@ -311,10 +591,69 @@ async def admin_create_user(body: CreateUserRequest, requester_id: str = Depends
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/admin/import-users")
+@limiter.limit("2/minute")
+async def admin_import_users(
+    request: Request,
+    users: Optional[Json[List[dict]]] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    requester_id: str = Depends(verify_admin)
+):
+    """
+    Bulk version of /admin/create-user: takes either `users` (JSON list of
+    CreateUserRequest objects) or a CSV `file` with the same columns.
+    Responds with a per-row report; invalid rows do not block the others.
+    """
+    if (users is None) == (file is None):
+        raise HTTPException(status_code=400, detail="Send either users (JSON) or a CSV file")
+    if file is not None:
+        upload = await spool_upload_file(file, MAX_FILE_SIZE)
+        try:
+            users = parse_users_csv(upload.open().read())
+        except (ValueError, UnicodeDecodeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid CSV: {e}")
+        finally:
+            upload.close()
+    if not users or len(users) > settings.USER_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {settings.USER_IMPORT_MAX_ROWS} users allowed")
+
+    db = firestore.client()
+    requester_doc = await run_in_threadpool(db.collection('users').document(requester_id).get)
+    requester_is_nutritionist = requester_doc.exists and requester_doc.to_dict().get('role') == 'nutritionist'
+
+    rows, report, seen_emails = [], {}, set()
+    for index, raw in enumerate(users):
+        try:
+            body = CreateUserRequest(**raw)
+        except (ValidationError, TypeError) as e:
+            report[index] = {"index": index, "email": (raw or {}).get('email') if isinstance(raw, dict) else None, "status": "error", "detail": str(e)}
+            continue
+        if len(body.password) < 6:
+            # auth.create_user enforces this, auth.import_users does not
+            report[index] = {"index": index, "email": body.email, "status": "error", "detail": "Password must be at least 6 characters"}
+            continue
+        # Firebase Auth treats emails case-insensitively
+        if body.email.lower() in seen_emails:
+            report[index] = {"index": index, "email": body.email, "status": "error", "detail": "Duplicate email in import"}
+            continue
+        seen_emails.add(body.email.lower())
+        rows.append({
+            "index": index,
+            **body.dict(),
+            # Same inheritance rule as /admin/create-user
+            "parent_id": requester_id if requester_is_nutritionist else body.parent_id,
+        })
+
+    if rows:
+        report.update(await import_users(db, rows, requester_id))
+    results = [report[i] for i in sorted(report)]
+    created = sum(1 for r in results if r["status"] == "created")
+    return {"total": len(users), "created": created, "error": len(results) - created, "results": results}
+
 @app.put("/admin/update-user/{target_uid}")
 async def admin_update_user(target_uid: str, body: UpdateUserRequest, requester_id: str = Depends(verify_admin)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         
         # Update Auth
         update_args = {}
@@ -345,12 +684,12 @@ async def admin_update_user(target_uid: str, body: UpdateUserRequest, requester_
 @app.post("/admin/assign-user")
 async def admin_assign_user(body: AssignUserRequest, requester_id: str = Depends(verify_admin)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         # Change role to user, assign parent
         db.collection('users').document(body.target_uid).update({
             'role': 'user',
             'parent_id': body.nutritionist_id,
-            'updated_at': firebase_admin.firestore.SERVER_TIMESTAMP
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
         auth.set_custom_user_claims(body.target_uid, {'role': 'user'})
         return {"message": "User assigned successfully"}
@@ -360,12 +699,12 @@ async def admin_assign_user(body: AssignUserRequest, requester_id: str = Depends
 @app.post("/admin/unassign-user")
 async def admin_unassign_user(body: UnassignUserRequest, requester_id: str = Depends(verify_admin)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         # Revert role to independent, remove parent
         db.collection('users').document(body.target_uid).update({
             'role': 'independent',
             'parent_id': firestore.DELETE_FIELD,
-            'updated_at': firebase_admin.firestore.SERVER_TIMESTAMP
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
         auth.set_custom_user_claims(body.target_uid, {'role': 'independent'})
         return {"message": "User unassigned successfully"}
@@ -377,7 +716,7 @@ async def admin_delete_user(target_uid: str, requester_id: str = Depends(verify_
     try:
         try: auth.delete_user(target_uid)
         except: pass
-        firebase_admin.firestore.client().collection('users').document(target_uid).delete()
+        firestore.client().collection('users').document(target_uid).delete()
         return {"message": "Deleted"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -385,7 +724,7 @@ async def admin_delete_user(target_uid: str, requester_id: str = Depends(verify_
 @app.post("/admin/sync-users")
 async def admin_sync_users(requester_id: str = Depends(verify_admin)):
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         
         # Iterate through all Auth users
         for user in auth.list_users().users:
@@ -404,7 +743,7 @@ async def admin_sync_users(requester_id: str = Depends(verify_admin)):
                     'role': 'independent',
                     'first_name': 'App', 
                     'last_name': '', 
-                    'created_at': firebase_admin.firestore.SERVER_TIMESTAMP
+                    'created_at': firestore.SERVER_TIMESTAMP
                 })
                 
         return {"message": "Synced & Cleaned"}
@@ -415,20 +754,23 @@ async def admin_sync_users(requester_id: str = Depends(verify_admin)):
 async def upload_parser_config(target_uid: str, file: UploadFile = File(...), requester_id: str = Depends(verify_admin)):
     try:
         content = (await file.read()).decode("utf-8")
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         
         db.collection('users').document(target_uid).update({
             'custom_parser_prompt': content, 
             'has_custom_parser': True,
-            'parser_updated_at': firebase_admin.firestore.SERVER_TIMESTAMP
+            'parser_updated_at': firestore.SERVER_TIMESTAMP
         })
         
         # History
         db.collection('users').document(target_uid).collection('parser_history').add({
             'content': content,
-            'uploaded_at': firebase_admin.firestore.SERVER_TIMESTAMP,
+            'uploaded_at': firestore.SERVER_TIMESTAMP,
             'uploaded_by': requester_id
         })
+
+        # Provider-side cache for the new prompt version, so the first upload doesn't pay for it
+        await run_in_threadpool(diet_parser.warm_prompt_cache, content)
         
         return {"message": "Updated"}
     except Exception as e:
@@ -440,7 +782,7 @@ async def log_sensitive_access(body: LogAccessRequest, requester_id: str = Depen
     Registra un accesso ai dati sensibili (PII) per audit.
     """
     try:
-        db = firebase_admin.firestore.client()
+        db = firestore.client()
         
         # Salviamo il log. Non permettiamo la modifica o cancellazione da API standard.
         db.collection('access_logs').add({
@@ -448,7 +790,7 @@ async def log_sensitive_access(body: LogAccessRequest, requester_id: str = Depen
             'target_uid': body.target_uid,
             'action': 'UNLOCK_PII_VIEW', # PII = Personally Identifiable Information
             'reason': body.reason,
-            'timestamp': firebase_admin.firestore.SERVER_TIMESTAMP,
+            'timestamp': firestore.SERVER_TIMESTAMP,
             'user_agent': 'kybo_admin_panel'
         })
         
@@ -461,7 +803,7 @@ async def log_sensitive_access(body: LogAccessRequest, requester_id: str = Depen
 
 @app.get("/admin/config/maintenance")
 async def get_maintenance_status(requester_id: str = Depends(verify_admin)):
-    doc = firebase_admin.firestore.client().collection('config').document('global').get()
+    doc = firestore.client().collection('config').document('global').get()
     return {"enabled": doc.to_dict().get('maintenance_mode', False)} if doc.exists else {"enabled": False}
 
 @app.post("/admin/config/maintenance")
@@ -469,12 +811,12 @@ async def set_maintenance_status(body: MaintenanceRequest, requester_id: str = D
     data = {'maintenance_mode': body.enabled, 'updated_by': requester_id}
     if body.message:
         data['maintenance_message'] = body.message
-    firebase_admin.firestore.client().collection('config').document('global').set(data, merge=True)
+    firestore.client().collection('config').document('global').set(data, merge=True)
     return {"message": "Updated"}
 
 @app.post("/admin/schedule-maintenance")
-async def schedule_maintenance(req: ScheduleMaintenanceRequest, admin_uid: str = Depends(verify_admin)):
-    firebase_admin.firestore.client().collection('config').document('global').set({
+async def schedule_maintenance(req: ScheduleMaintenanceRequest, background_tasks: BackgroundTasks, admin_uid: str = Depends(verify_admin)):
+    firestore.client().collection('config').document('global').set({
         "scheduled_maintenance_start": req.scheduled_time,
         "maintenance_message": req.message,
         "is_scheduled": True
@@ -482,58 +824,164 @@ async def schedule_maintenance(req: ScheduleMaintenanceRequest, admin_uid: str =
     
     if req.notify:
         try:
-            broadcast_message(title="System Update", body=req.message, data={"type": "maintenance_alert"})
+            job_id = create_broadcast_report("System Update", 'all', None, admin_uid)
+            background_tasks.add_task(run_segment_broadcast, job_id, "System Update", req.message, {"type": "maintenance_alert"}, 'all', None)
         except: pass
     return {"status": "scheduled"}
 
+@app.post("/admin/broadcast")
+async def admin_broadcast(body: BroadcastRequest, background_tasks: BackgroundTasks, requester_id: str = Depends(verify_admin)):
+    segment_type, segment_value = body.segment_type, body.segment_value
+    if segment_type != 'all' and not segment_value:
+        raise HTTPException(status_code=400, detail="segment_value required")
+
+    # Nutritionists may only reach their own patients
+    requester_doc = firestore.client().collection('users').document(requester_id).get()
+    if requester_doc.exists and requester_doc.to_dict().get('role') == 'nutritionist':
+        segment_type, segment_value = 'nutritionist', requester_id
+
+    job_id = create_broadcast_report(body.title, segment_type, segment_value, requester_id)
+    background_tasks.add_task(run_segment_broadcast, job_id, body.title, body.body, body.data, segment_type, segment_value)
+    return {"status": "queued", "job_id": job_id}
+
+@app.get("/admin/broadcast/{job_id}")
+async def get_broadcast_report(job_id: str, requester_id: str = Depends(verify_admin)):
+    db = firestore.client()
+    doc = db.collection('broadcast_reports').document(job_id).get()
+    if not doc.exists:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    data = doc.to_dict()
+    # Nutritionists only see the reports of their own broadcasts
+    if data.get('created_by') != requester_id:
+        requester_doc = db.collection('users').document(requester_id).get()
+        if not requester_doc.exists or requester_doc.to_dict().get('role') != 'admin':
+            raise HTTPException(status_code=404, detail="Broadcast not found")
+    return {"job_id": job_id, **data}
+
 @app.post("/admin/cancel-maintenance")
 async def cancel_maintenance_schedule(requester_id: str = Depends(verify_admin)):
-    firebase_admin.firestore.client().collection('config').document('global').update({
+    firestore.client().collection('config').document('global').update({
         "is_scheduled": False,
         "scheduled_maintenance_start": firestore.DELETE_FIELD,
         "maintenance_message": firestore.DELETE_FIELD
     })
     return {"status": "cancelled"}
 
-def _convert_to_app_format(gemini_output) -> DietResponse:
-    if not gemini_output: return DietResponse(plan={}, substitutions={})
-    app_plan, app_substitutions = {}, {}
-    cad_map = {}
-    
-    for g in gemini_output.get('tabella_sostituzioni', []):
+@app.get("/admin/diet-history")
+async def list_diet_history(
+    userId: Optional[str] = None,
+    uploadedBy: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    requester_id: str = Depends(verify_admin)
+):
+    """
+    Newest-first page of diet uploads read from the summary docs, never the full plans.
+    `cursor` is the `next_cursor` of the previous page; `fields` is a comma-separated projection.
+    Each item's `id` is also the id of its diet_history document.
+    """
+    db = firestore.client()
+    requester_doc = await run_in_threadpool(db.collection('users').document(requester_id).get)
+    if requester_doc.exists and requester_doc.to_dict().get('role') == 'nutritionist':
+        # Nutritionists see their own uploads, or the history of one of their patients
+        if userId:
+            patient_doc = await run_in_threadpool(db.collection('users').document(userId).get)
+            if not patient_doc.exists or patient_doc.to_dict().get('parent_id') != requester_id:
+                raise HTTPException(status_code=403, detail="Patient not assigned to requester")
+        else:
+            uploadedBy = requester_id
+
+    projection = None
+    if fields:
+        projection = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = set(projection) - DIET_SUMMARY_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    collection = db.collection(DIET_SUMMARY_COLLECTION)
+    query = collection
+    if userId:
+        query = query.where('userId', '==', userId)
+    if uploadedBy:
+        query = query.where('uploadedBy', '==', uploadedBy)
+    if projection is not None:
+        query = query.select(projection)
+    query = query.order_by('uploadedAt', direction=firestore.Query.DESCENDING)
+    if cursor:
+        cursor_doc = await run_in_threadpool(collection.document(cursor).get)
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+
+    # One extra row tells whether another page exists
+    docs = await run_in_threadpool(lambda: list(query.limit(limit + 1).stream()))
+    page = docs[:limit]
+    return {
+        "items": [{"id": d.id, **d.to_dict()} for d in page],
+        "next_cursor": page[-1].id if len(docs) > limit else None,
+    }
+
+@app.get("/admin/metrics")
+async def get_metrics(requester_id: str = Depends(verify_admin)):
+    return metrics.snapshot()
+
+def _convert_substitutions(groups) -> tuple[dict, dict]:
+    """Returns (cad_map, app_substitutions) for a `tabella_sostituzioni` list."""
+    app_substitutions, cad_map = {}, {}
+    for g in groups or []:
         if g.get('cad_code', 0) > 0:
             cad_map[g.get('titolo', '').strip().lower()] = g['cad_code']
             app_substitutions[str(g['cad_code'])] = SubstitutionGroup(
                 name=g.get('titolo', ''),
                 options=[SubstitutionOption(name=o.get('nome',''), qty=o.get('quantita','')) for o in g.get('opzioni',[])]
             )
+    return cad_map, app_substitutions
 
+def _convert_day(day, cad_map: dict) -> tuple[str, dict]:
+    """Normalizes one `piano_settimanale` entry into (day name, meals)."""
     day_map = {"lun": "Lunedì", "mar": "Martedì", "mer": "Mercoledì", "gio": "Giovedì", "ven": "Venerdì", "sab": "Sabato", "dom": "Domenica"}
-    
+    raw_name = day.get('giorno', '').lower().strip()
+    day_name = day_map.get(raw_name[:3], raw_name.capitalize())
+    meals = {}
+
+    for meal in day.get('pasti', []):
+        m_name = normalize_meal_name(meal.get('tipo_pasto', ''))
+        dishes = []
+        for d in meal.get('elenco_piatti', []):
+            d_name = d.get('nome_piatto') or 'Piatto'
+            dishes.append(Dish(
+                name=d_name,
+                qty=str(d.get('quantita_totale') or ''),
+                cad_code=d.get('cad_code', 0) or cad_map.get(d_name.lower(), 0),
+                is_composed=(d.get('tipo') == 'composto'),
+                ingredients=[Ingredient(name=str(i.get('nome','')), qty=str(i.get('quantita',''))) for i in d.get('ingredienti', [])]
+            ))
+        if m_name in meals: meals[m_name].extend(dishes)
+        else: meals[m_name] = dishes
+
+    return day_name, meals
+
+def _order_meals(meals: dict) -> dict:
+    ordered = {k: meals[k] for k in MEAL_ORDER if k in meals}
+    for k in meals:
+        if k not in ordered: ordered[k] = meals[k]
+    return ordered
+
+def _convert_to_app_format(gemini_output) -> DietResponse:
+    if not gemini_output: return DietResponse(plan={}, substitutions={})
+    app_plan = {}
+    cad_map, app_substitutions = _convert_substitutions(gemini_output.get('tabella_sostituzioni', []))
+
     for day in gemini_output.get('piano_settimanale', []):
-        raw_name = day.get('giorno', '').lower().strip()
-        day_name = day_map.get(raw_name[:3], raw_name.capitalize())
-        app_plan[day_name] = {}
-        
-        for meal in day.get('pasti', []):
-            m_name = normalize_meal_name(meal.get('tipo_pasto', ''))
-            dishes = []
-            for d in meal.get('elenco_piatti', []):
-                d_name = d.get('nome_piatto') or 'Piatto'
-                dishes.append(Dish(
-                    name=d_name,
-                    qty=str(d.get('quantita_totale') or ''),
-                    cad_code=d.get('cad_code', 0) or cad_map.get(d_name.lower(), 0),
-                    is_composed=(d.get('tipo') == 'composto'),
-                    ingredients=[Ingredient(name=str(i.get('nome','')), qty=str(i.get('quantita',''))) for i in d.get('ingredienti', [])]
-                ))
-            if m_name in app_plan[day_name]: app_plan[day_name][m_name].extend(dishes)
-            else: app_plan[day_name][m_name] = dishes
+        day_name, meals = _convert_day(day, cad_map)
+        app_plan[day_name] = meals
 
     # Order meals
     for d, meals in app_plan.items():
-        app_plan[d] = {k: meals[k] for k in MEAL_ORDER if k in meals}
-        for k in meals: 
-            if k not in app_plan[d]: app_plan[d][k] = meals[k]
+        app_plan[d] = _order_meals(meals)
+
+    return DietResponse(plan=app_plan, substitutions=app_substitutions)
 
-    return DietResponse(plan=app_plan, substitutions=app_substitutions)
\ No newline at end of file
+_main_import_seconds = time.perf_counter() - _IMPORT_STARTED
+metrics.set_gauge("startup.main_import_seconds", round(_main_import_seconds, 4))
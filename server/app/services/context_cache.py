@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+from app.services.gemini_gateway import gemini_gateway
+
+firestore = lazy_import("firebase_admin.firestore")
+types = lazy_import("google.genai.types")
+errors = lazy_import("google.genai.errors")
+
+
+def is_stale_cache_error(exc: BaseException) -> bool:
+    """True when a request failed because its cached content no longer exists server-side."""
+    return isinstance(exc, errors.ClientError) and (exc.code == 404 or exc.status == "NOT_FOUND")
+
+
+class CacheEntry:
+    def __init__(self, name: str, expires_at: float):
+        self.name = name
+        self.expires_at = expires_at
+
+
+class CacheStore:
+    """Where prompt-version -> provider cache name mappings live. Subclass to plug in another backend."""
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class InMemoryCacheStore(CacheStore):
+    def __init__(self):
+        self._entries: dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class FirestoreCacheStore(CacheStore):
+    """Shares cache names between instances through the `context_caches` collection."""
+
+    def _doc(self, key: str):
+        return firestore.client().collection('context_caches').document(key)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        doc = self._doc(key).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return CacheEntry(data['name'], data['expires_at'])
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        self._doc(key).set({'name': entry.name, 'expires_at': entry.expires_at})
+
+    def delete(self, key: str) -> None:
+        self._doc(key).delete()
+
+
+class GeminiCacheProvider:
+    """Creates and refreshes provider-side cached contents holding a system instruction."""
+
+    def create(self, client, model: str, instruction: str, ttl_seconds: int, display_name: str) -> str:
+        cache = client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=instruction,
+                display_name=display_name,
+                ttl=f"{ttl_seconds}s",
+            ),
+        )
+        return cache.name
+
+    def refresh(self, client, name: str, ttl_seconds: int) -> None:
+        client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl_seconds}s"))
+
+    def delete(self, client, name: str) -> None:
+        client.caches.delete(name=name)
+
+
+class ContextCache:
+    """
+    Keeps one provider-side cached content per (model, prompt version) so long
+    system instructions are referenced instead of resent with every request.
+    Entries are refreshed when they get close to their TTL; any provider error
+    makes callers fall back to sending the instruction inline. Provider calls go
+    through gemini_gateway, so they share its deadline and circuit breaker.
+    """
+
+    def __init__(self, store: CacheStore, provider):
+        self.store = store
+        self.provider = provider
+        # Per-key locks: concurrent requests don't create duplicate caches, and a
+        # slow create for one prompt doesn't hold up the others
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _provider_call(self, fn):
+        return gemini_gateway.call(fn, operation="context_cache", timeout=settings.CONTEXT_CACHE_TIMEOUT_SECONDS)
+
+    @staticmethod
+    def key(model: str, instruction: str) -> str:
+        version = hashlib.sha256(instruction.encode("utf-8")).hexdigest()[:16]
+        return f"{model.replace('/', '_')}-{version}"
+
+    def get_or_create(self, client, model: str, instruction: str) -> Optional[str]:
+        """Returns the cached content name for this prompt, or None to send it inline."""
+        if not settings.CONTEXT_CACHE_ENABLED or client is None:
+            return None
+        # Providers reject caches below a minimum token count
+        if len(instruction) < settings.CONTEXT_CACHE_MIN_CHARS:
+            return None
+
+        key = self.key(model, instruction)
+        now = time.time()
+        try:
+            entry = self.store.get(key)
+            if entry and entry.expires_at - now > settings.CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                metrics.incr("context_cache.hits")
+                return entry.name
+            return self._refresh_or_create(client, model, instruction, key)
+        except Exception as e:
+            metrics.incr("context_cache.errors")
+            print(f"⚠️ Context cache unavailable, sending prompt inline: {e}")
+            return None
+
+    def _refresh_or_create(self, client, model: str, instruction: str, key: str) -> str:
+        ttl = settings.CONTEXT_CACHE_TTL_SECONDS
+        with self._lock_for(key):
+            now = time.time()
+            entry = self.store.get(key)
+            if entry and entry.expires_at - now > settings.CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                return entry.name
+            if entry and entry.expires_at > now:
+                try:
+                    self._provider_call(lambda: self.provider.refresh(client, entry.name, ttl))
+                    self.store.put(key, CacheEntry(entry.name, now + ttl))
+                    metrics.incr("context_cache.refreshed")
+                    return entry.name
+                except Exception as e:
+                    print(f"⚠️ Context cache refresh failed, recreating: {e}")
+
+            name = self._provider_call(lambda: self.provider.create(client, model, instruction, ttl, key))
+            self.store.put(key, CacheEntry(name, now + ttl))
+            metrics.incr("context_cache.created")
+            print(f"🗄️ Context cache created: {name}")
+            return name
+
+    def invalidate(self, model: str, instruction: str) -> None:
+        """Forgets an entry the provider no longer recognises (deleted/expired server-side)."""
+        try:
+            self.store.delete(self.key(model, instruction))
+        except Exception as e:
+            print(f"⚠️ Context cache invalidate failed: {e}")
+
+
+def _build_context_cache() -> ContextCache:
+    store = FirestoreCacheStore() if settings.CONTEXT_CACHE_STORE == "firestore" else InMemoryCacheStore()
+    return ContextCache(store, GeminiCacheProvider())
+
+
+context_cache = _build_context_cache()
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import re
+import zlib
+from typing import Optional
+
+from app.services.model_router import SUBSTITUTION_PATTERN
+
+# Day headings in the languages the parser accepts -> 3-letter Italian key ("lun", "mar", ...)
+DAY_PATTERNS = {
+    "lun": r"luned[iì]|monday|lunes|lundi|montag",
+    "mar": r"marted[iì]|tuesday|martes|mardi|dienstag",
+    "mer": r"mercoled[iì]|wednesday|mi[eé]rcoles|mercredi|mittwoch",
+    "gio": r"gioved[iì]|thursday|jueves|jeudi|donnerstag",
+    "ven": r"venerd[iì]|friday|viernes|vendredi|freitag",
+    "sab": r"sabato|saturday|s[aá]bado|samedi|samstag",
+    "dom": r"domenica|sunday|domingo|dimanche|sonntag",
+}
+DAY_ORDER = {key: i for i, key in enumerate(DAY_PATTERNS)}
+DAY_REGEX = re.compile(
+    "|".join(f"(?P<{key}>\\b(?:{pattern})\\b)" for key, pattern in DAY_PATTERNS.items()),
+    re.IGNORECASE,
+)
+
+
+def page_fingerprint(text: str) -> str:
+    # Whitespace-insensitive: layout=True extraction pads lines differently across exports
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+def day_key(giorno: str) -> str:
+    return (giorno or "").lower().strip()[:3]
+
+
+def pack_output(output: dict) -> bytes:
+    # The state keeps the raw parser output only to merge partial re-parses into: store it deflated
+    return zlib.compress(json.dumps(output, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def state_output(state: Optional[dict]) -> Optional[dict]:
+    """Raw output stored in a parser state (`output_z`, or the uncompressed `output` of older states)."""
+    if not state:
+        return None
+    if state.get("output_z") is not None:
+        return json.loads(zlib.decompress(state["output_z"]).decode("utf-8"))
+    return state.get("output")
+
+
+def is_substitution_page(text: str) -> bool:
+    return bool(SUBSTITUTION_PATTERN.search(text))
+
+
+def substitution_pages(page_texts: list[str]) -> list[int]:
+    return [i for i, text in enumerate(page_texts) if is_substitution_page(text)]
+
+
+def page_days(page_texts: list[str]) -> list[list[str]]:
+    """
+    Day keys covered by each page, in order. A page whose text starts before
+    any heading continues the last day of the previous page.
+    """
+    result = []
+    current = None
+    for text in page_texts:
+        days = []
+        matches = list(DAY_REGEX.finditer(text))
+        if not matches and is_substitution_page(text):
+            # The CAD table closes the weekly plan
+            current = None
+        leading = text[:matches[0].start()] if matches else text
+        if current and leading.strip():
+            days.append(current)
+        for match in matches:
+            if match.lastgroup not in days:
+                days.append(match.lastgroup)
+            current = match.lastgroup
+        result.append(days)
+    return result
+
+
+def plan_reparse(page_texts: list[str], previous: Optional[dict], max_changed_ratio: float) -> Optional[dict]:
+    """
+    Compares the new pages with the previous parse state.
+    Returns None when a full parse is needed, otherwise a plan:
+    {"unchanged": bool, "days": day keys to re-extract, "substitutions": bool,
+     "pages": page indexes to send}.
+    """
+    if not previous or not previous.get("page_hashes"):
+        return None
+
+    hashes = [page_fingerprint(t) for t in page_texts]
+    new_days = page_days(page_texts)
+    old_hashes = previous["page_hashes"]
+    # Stored comma-joined: Firestore has no nested arrays
+    old_days = [d.split(",") if d else [] for d in previous.get("page_days") or []]
+
+    old_set, new_set = set(old_hashes), set(hashes)
+    changed = [i for i, h in enumerate(hashes) if h not in old_set]
+    removed = [i for i, h in enumerate(old_hashes) if h not in new_set]
+    if not changed and not removed:
+        return {"unchanged": True, "days": [], "substitutions": False, "pages": []}
+    if len(changed) > max_changed_ratio * len(hashes):
+        return None
+
+    affected_days = set()
+    substitutions = False
+    for i in changed:
+        if is_substitution_page(page_texts[i]):
+            substitutions = True
+        elif not new_days[i]:
+            # Changed content we cannot attribute to a day or to the CAD table
+            return None
+        affected_days.update(new_days[i])
+    old_substitution_pages = set(previous.get("substitution_pages") or [])
+    for i in removed:
+        affected_days.update(old_days[i] if i < len(old_days) else [])
+        if i in old_substitution_pages:
+            substitutions = True
+
+    pages = [
+        i for i, days in enumerate(new_days)
+        if affected_days.intersection(days) or (substitutions and is_substitution_page(page_texts[i]))
+    ]
+    present_days = {d for days in new_days for d in days}
+    return {
+        "unchanged": False,
+        "days": sorted(affected_days & present_days),
+        "substitutions": substitutions,
+        "pages": pages,
+    }
+
+
+def merge_outputs(previous_output: dict, partial_output: dict, plan: dict, page_texts: list[str]) -> dict:
+    """
+    Replaces the re-extracted days (and the CAD table, if it changed) in the
+    previous OutputDietaCompleto. Days no longer present in the document are dropped.
+    Only the planned days are taken from the partial answer: the pages sent also
+    hold fragments of neighbouring days, which must not replace the stored ones.
+    """
+    present_days = {d for days in page_days(page_texts) for d in days}
+    planned = set(plan["days"])
+    replaced = {
+        key: d for d in partial_output.get("piano_settimanale", [])
+        if (key := day_key(d.get("giorno"))) in planned
+    }
+
+    merged_days = []
+    for day in previous_output.get("piano_settimanale", []):
+        key = day_key(day.get("giorno"))
+        if key in replaced:
+            merged_days.append(replaced.pop(key))
+        elif not present_days or key in present_days:
+            merged_days.append(day)
+    merged_days.extend(replaced.values())
+    merged_days.sort(key=lambda d: DAY_ORDER.get(day_key(d.get("giorno")), len(DAY_ORDER)))
+
+    substitutions = previous_output.get("tabella_sostituzioni", [])
+    if plan["substitutions"]:
+        substitutions = partial_output.get("tabella_sostituzioni", [])
+
+    return {"piano_settimanale": merged_days, "tabella_sostituzioni": substitutions}
@@ -1,11 +1,18 @@
 import json
 import re
 import io
-import pdfplumber
-import os
-from google import genai
-from google.genai import types
+import resource
+import hashlib
+import time
+from typing import Iterator, Optional, Union, BinaryIO
 from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+from app.services.upload_service import source_size
+from app.services.model_router import model_router
+from app.services.gemini_gateway import gemini_gateway, GeminiTimeoutError
+from app.services.context_cache import context_cache, is_stale_cache_error
+from app.services import diet_diff
 from app.models.schemas import (
     DietResponse, 
     Dish, 
@@ -15,6 +22,17 @@ from app.models.schemas import (
 )
 import typing_extensions as typing
 
+# Heavy dependencies are imported on first use (see core/lazy.py)
+pdfplumber = lazy_import("pdfplumber")
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
+errors = lazy_import("google.genai.errors")
+
+DAY_NAMES = {"lun": "Lunedì", "mar": "Martedì", "mer": "Mercoledì", "gio": "Giovedì", "ven": "Venerdì", "sab": "Sabato", "dom": "Domenica"}
+
+# Rough chars-per-token ratio used to turn DIET_TEXT_TOKEN_BUDGET into a char cutoff
+CHARS_PER_TOKEN = 4
+
 # --- DATA SCHEMAS (Your Original TypedDicts) ---
 class Ingrediente(typing.TypedDict):
     nome: str
@@ -102,25 +120,79 @@ OUTPUT FORMAT (Strict JSON):
   "tabella_sostituzioni": []
 }"""
 
-    def _extract_text_from_pdf(self, pdf_path: str) -> str:
+    @staticmethod
+    def _current_rss() -> int:
+        # Resident set size in bytes (Linux); falls back to the process high-water mark
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (OSError, ValueError, IndexError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @staticmethod
+    def _release_page(page) -> None:
+        # Drops the page's cached chars/layout objects so they can be collected right away
+        close = getattr(page, "close", None) or page.flush_cache
+        close()
+
+    def _iter_pdf_pages(self, pdf) -> Iterator[tuple[int, str]]:
+        """Yields (page_number, text) one page at a time, releasing each page once read."""
+        for page_number, page in enumerate(pdf.pages, start=1):
+            try:
+                yield page_number, page.extract_text(layout=True) or ""
+            finally:
+                self._release_page(page)
+
+    def _extract_text_from_pdf(self, source: Union[str, BinaryIO], stats: Optional[dict] = None, page_texts: Optional[list] = None) -> str:
         # [PRESERVED] Your Memory Optimization using StringIO
+        # `source` is a path or an in-memory buffer (see upload_service.SpooledUpload).
+        # Extraction stops early once DIET_TEXT_CHAR_BUDGET / DIET_TEXT_TOKEN_BUDGET is reached;
+        # if `stats` is given it is filled with pages read, truncation and peak memory,
+        # if `page_texts` is given each page's text is appended to it.
         text_buffer = io.StringIO()
+        budgets = [b for b in (settings.DIET_TEXT_CHAR_BUDGET, settings.DIET_TEXT_TOKEN_BUDGET * CHARS_PER_TOKEN) if b]
+        char_budget = min(budgets) if budgets else 0
+        baseline_rss = peak_rss = self._current_rss()
+        pages_read = page_count = 0
+        truncated = False
         try:
-            file_size = os.path.getsize(pdf_path)
+            file_size = source_size(source)
             if file_size > 10 * 1024 * 1024: 
                 raise ValueError("PDF troppo grande per l'elaborazione (Max 10MB).")
 
-            with pdfplumber.open(pdf_path) as pdf:
-                if len(pdf.pages) > 50:
+            with pdfplumber.open(source) as pdf:
+                page_count = len(pdf.pages)
+                if page_count > 50:
                     raise ValueError("Il PDF ha troppe pagine (Max 50).")
                 
-                for page in pdf.pages:
-                    extracted = page.extract_text(layout=True) 
+                for page_number, extracted in self._iter_pdf_pages(pdf):
+                    pages_read = page_number
+                    peak_rss = max(peak_rss, self._current_rss())
+                    if page_texts is not None:
+                        page_texts.append(extracted)
                     if extracted:
                         text_buffer.write(extracted)
                         text_buffer.write("\n")
+                    if char_budget and text_buffer.tell() >= char_budget:
+                        truncated = True
+                        break
             
-            return text_buffer.getvalue()
+            text = text_buffer.getvalue()
+            if truncated:
+                text = text[:char_budget]
+                print(f"✂️ PDF text budget reached after page {pages_read}/{page_count} ({char_budget} chars)")
+
+            peak_delta = peak_rss - baseline_rss
+            print(f"📄 PDF extracted: {pages_read}/{page_count} pages, {len(text)} chars, peak RSS +{peak_delta // 1024} KiB")
+            if stats is not None:
+                stats.update({
+                    "page_count": page_count,
+                    "pages_read": pages_read,
+                    "chars": len(text),
+                    "truncated": truncated,
+                    "peak_rss_delta_bytes": peak_delta,
+                })
+            return text
         except Exception as e:
             print(f"❌ Errore lettura PDF: {e}")
             raise e
@@ -145,16 +217,97 @@ OUTPUT FORMAT (Strict JSON):
         
         raise ValueError("Impossibile estrarre JSON valido dalla risposta Gemini.")
 
-    # [UPDATED] Added optional custom_instructions parameter
-    def parse_complex_diet(self, file_path: str, custom_instructions: str = None):
-        if not self.client:
-            raise ValueError("Client Gemini non inizializzato (manca API KEY).")
+    def _build_prompt(self, diet_text: str, scope: str = "") -> str:
+        return f"""
+            Analizza il seguente testo ed estrai i dati della dieta e le sostituzioni CAD.
+            {scope}
+            <source_document>
+            {diet_text}
+            </source_document>
+            """
 
-        diet_text = self._extract_text_from_pdf(file_path)
-        if not diet_text:
-            raise ValueError("PDF vuoto o illeggibile.")
+    def _generation_config(self, final_instruction: str, model_name: str, use_cache: bool = True, timeout: Optional[float] = None) -> "types.GenerateContentConfig":
+        # Transport-level timeout, for calls that cannot go through the gateway's deadline (streaming)
+        extra = {'http_options': types.HttpOptions(timeout=int(timeout * 1000))} if timeout else {}
+        # Long prompts are referenced through a provider-side cache instead of resent
+        cached_content = context_cache.get_or_create(self.client, model_name, final_instruction) if use_cache else None
+        if cached_content:
+            return types.GenerateContentConfig(
+                cached_content=cached_content,
+                response_mime_type="application/json",
+                response_schema=OutputDietaCompleto,
+                **extra
+            )
+        return types.GenerateContentConfig(
+            system_instruction=final_instruction, # <--- Uses the dynamic prompt
+            response_mime_type="application/json",
+            response_schema=OutputDietaCompleto,
+            **extra
+        )
 
-        model_name = settings.GEMINI_MODEL
+    def warm_prompt_cache(self, instructions: str) -> None:
+        """Creates the cached content for a (new) nutritionist prompt ahead of the first upload."""
+        context_cache.get_or_create(self.client, settings.GEMINI_MODEL, instructions)
+
+    @staticmethod
+    def _is_valid_output(data, require_days: bool = True) -> bool:
+        # Structural check against OutputDietaCompleto, used to decide on model escalation
+        if not isinstance(data, dict) or not isinstance(data.get('tabella_sostituzioni', []), list):
+            return False
+        days = data.get('piano_settimanale')
+        if not isinstance(days, list) or (require_days and not days):
+            return False
+        for day in days:
+            if not isinstance(day, dict) or not day.get('giorno') or not isinstance(day.get('pasti'), list):
+                return False
+            for meal in day['pasti']:
+                if not isinstance(meal, dict) or not isinstance(meal.get('elenco_piatti'), list):
+                    return False
+                if any(not isinstance(d, dict) or 'nome_piatto' not in d for d in meal['elenco_piatti']):
+                    return False
+        return True
+
+    def _generate(self, model_name: str, diet_text: str, final_instruction: str, scope: str = ""):
+        config = self._generation_config(final_instruction, model_name)
+        try:
+            # Deadline, retries, hedging and circuit breaker: see gemini_gateway.py
+            response = gemini_gateway.generate_content(
+                self.client,
+                model=model_name,
+                contents=self._build_prompt(diet_text, scope),
+                config=config,
+                operation="diet",
+                timeout=settings.GEMINI_DIET_TIMEOUT_SECONDS
+            )
+        except errors.ClientError as e:
+            # Other 4xx (429, schema 400...) must not trigger a second request
+            if not config.cached_content or not is_stale_cache_error(e):
+                raise
+            # Cache deleted or expired server-side: forget it and resend the prompt inline
+            context_cache.invalidate(model_name, final_instruction)
+            response = gemini_gateway.generate_content(
+                self.client,
+                model=model_name,
+                contents=self._build_prompt(diet_text, scope),
+                config=self._generation_config(final_instruction, model_name, use_cache=False),
+                operation="diet",
+                timeout=settings.GEMINI_DIET_TIMEOUT_SECONDS
+            )
+        
+        # Prioritize structured parsing provided by SDK
+        if hasattr(response, 'parsed') and response.parsed:
+            return response.parsed
+        
+        # Fallback to text parsing
+        if hasattr(response, 'text') and response.text:
+            return self._extract_json_from_text(response.text)
+        
+        raise ValueError("Risposta vuota da Gemini")
+
+    def _parse_text(self, diet_text: str, page_count: int, custom_instructions: str = None, scope: str = "", require_days: bool = True):
+        # Model picked from document size/complexity, see model_router.py
+        features = model_router.diet_features(diet_text, page_count, custom_instructions)
+        model_name = model_router.route(features)
         
         # [NEW LOGIC] Determine which prompt to use
         # If custom_instructions exists, use it. Otherwise, use self.system_instruction.
@@ -162,35 +315,246 @@ OUTPUT FORMAT (Strict JSON):
         
         try:
             print(f"🤖 Analisi Gemini ({model_name})... Using Custom Prompt: {bool(custom_instructions)}")
-            
-            prompt = f"""
-            Analizza il seguente testo ed estrai i dati della dieta e le sostituzioni CAD.
-            
-            <source_document>
-            {diet_text}
-            </source_document>
-            """
 
-            response = self.client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    system_instruction=final_instruction, # <--- Uses the dynamic prompt
-                    response_mime_type="application/json",
-                    response_schema=OutputDietaCompleto
+            escalation = model_router.escalation_for(model_name)
+            try:
+                data = self._generate(model_name, diet_text, final_instruction, scope)
+            except ValueError:
+                # Unparseable output (not a timeout / outage): worth a try on the larger model
+                if not escalation:
+                    raise
+                data = None
+
+            if escalation and not self._is_valid_output(data, require_days):
+                print(f"⬆️ Output non valido da {model_name}, riprovo con {escalation}")
+                metrics.incr("model_router.diet.escalated")
+                data = self._generate(escalation, diet_text, final_instruction, scope)
+
+            return data
+
+        except Exception as e:
+            print(f"⚠️ Errore con Gemini: {e}")
+            raise e
+
+    # [UPDATED] Added optional custom_instructions parameter
+    def parse_complex_diet(self, source: Union[str, BinaryIO], custom_instructions: str = None):
+        if not self.client:
+            raise ValueError("Client Gemini non inizializzato (manca API KEY).")
+
+        stats = {}
+        diet_text = self._extract_text_from_pdf(source, stats)
+        if not diet_text:
+            raise ValueError("PDF vuoto o illeggibile.")
+
+        return self._parse_text(diet_text, stats.get('page_count', 0), custom_instructions)
+
+    def parse_complex_diet_incremental(self, source: Union[str, BinaryIO], custom_instructions: str = None, previous_state: Optional[dict] = None) -> tuple[dict, dict]:
+        """
+        Re-parses a revised diet: pages are fingerprinted and compared with the
+        state of the patient's previous parse; only the days (or CAD table)
+        touched by changed pages are sent to Gemini and merged into the previous
+        output. Falls back to a full parse when the change cannot be localized.
+        Returns (OutputDietaCompleto, new state to persist).
+        """
+        if not self.client:
+            raise ValueError("Client Gemini non inizializzato (manca API KEY).")
+
+        stats, page_texts = {}, []
+        diet_text = self._extract_text_from_pdf(source, stats, page_texts)
+        if not diet_text:
+            raise ValueError("PDF vuoto o illeggibile.")
+
+        final_instruction = custom_instructions if custom_instructions else self.system_instruction
+        prompt_version = hashlib.sha256(final_instruction.encode("utf-8")).hexdigest()[:16]
+        if previous_state and previous_state.get("prompt_version") != prompt_version:
+            previous_state = None
+        previous_output = diet_diff.state_output(previous_state)
+        if previous_output is None:
+            previous_state = None
+
+        plan = diet_diff.plan_reparse(page_texts, previous_state, settings.DIET_INCREMENTAL_MAX_CHANGED_RATIO)
+        data = None
+        if plan is not None and plan["unchanged"]:
+            print("♻️ PDF invariato rispetto al caricamento precedente")
+            metrics.incr("diet.incremental.unchanged")
+            data = previous_output
+        elif plan is not None and not plan["pages"]:
+            # Only pages removed: drop what disappeared, nothing to extract
+            metrics.incr("diet.incremental.partial")
+            data = diet_diff.merge_outputs(previous_output, {}, plan, page_texts)
+        elif plan is not None:
+            data = self._reparse_changed(page_texts, plan, previous_output, custom_instructions)
+
+        if data is None:
+            metrics.incr("diet.incremental.full")
+            data = self._parse_text(diet_text, stats.get('page_count', 0), custom_instructions)
+
+        state = {
+            "prompt_version": prompt_version,
+            "page_hashes": [diet_diff.page_fingerprint(t) for t in page_texts],
+            "page_days": [",".join(days) for days in diet_diff.page_days(page_texts)],
+            "substitution_pages": diet_diff.substitution_pages(page_texts),
+            "output_z": diet_diff.pack_output(data),
+        }
+        return data, state
+
+    def _reparse_changed(self, page_texts: list, plan: dict, previous_output: dict, custom_instructions: str = None) -> Optional[dict]:
+        # Returns the merged output, or None if the partial answer can't be trusted
+        day_names = [DAY_NAMES[d] for d in plan["days"]]
+        scope = []
+        if day_names:
+            scope.append(f"Estrai SOLO questi giorni: {', '.join(day_names)}.")
+        else:
+            scope.append("`piano_settimanale` deve essere una lista vuota.")
+        if plan["substitutions"]:
+            scope.append("Estrai anche la tabella delle sostituzioni CAD completa.")
+        else:
+            scope.append("`tabella_sostituzioni` deve essere una lista vuota.")
+
+        partial_text = "\n".join(page_texts[i] for i in plan["pages"])
+        print(f"✂️ Re-parse incrementale: pagine {[i + 1 for i in plan['pages']]}, giorni {day_names}")
+        try:
+            partial = self._parse_text(partial_text, len(plan["pages"]), custom_instructions, " ".join(scope), require_days=bool(day_names))
+        except ValueError as e:
+            print(f"⚠️ Re-parse incrementale fallito, parse completo: {e}")
+            return None
+
+        returned_days = {diet_diff.day_key(d.get('giorno')) for d in (partial or {}).get('piano_settimanale', [])}
+        if not self._is_valid_output(partial, require_days=bool(day_names)) or not set(plan["days"]) <= returned_days:
+            print("⚠️ Re-parse incrementale incompleto, parse completo")
+            return None
+
+        metrics.incr("diet.incremental.partial")
+        return diet_diff.merge_outputs(previous_output, partial, plan, page_texts)
+
+    def parse_complex_diet_stream(self, source: Union[str, BinaryIO], custom_instructions: str = None) -> Iterator[tuple[str, object]]:
+        """
+        Streaming variant of parse_complex_diet.
+        Yields ("day", GiornoDieta) as soon as each day of `piano_settimanale` is
+        complete in the model output, then ("substitutions", tabella_sostituzioni).
+        """
+        if not self.client:
+            raise ValueError("Client Gemini non inizializzato (manca API KEY).")
+
+        stats = {}
+        diet_text = self._extract_text_from_pdf(source, stats)
+        if not diet_text:
+            raise ValueError("PDF vuoto o illeggibile.")
+
+        # No escalation here: days already streamed to the client cannot be taken back
+        features = model_router.diet_features(diet_text, stats.get('page_count', 0), custom_instructions)
+        model_name = model_router.route(features)
+        final_instruction = custom_instructions if custom_instructions else self.system_instruction
+
+        try:
+            print(f"🤖 Analisi Gemini streaming ({model_name})... Using Custom Prompt: {bool(custom_instructions)}")
+
+            extractor = DayStreamExtractor()
+            # Keys of the days already streamed: the extractor may skip one it cannot decode
+            emitted = set()
+            timeout = settings.GEMINI_DIET_TIMEOUT_SECONDS
+            gemini_gateway.check("diet_stream")
+            started = time.perf_counter()
+            try:
+                # The transport timeout catches a stalled stream, the deadline a trickling one
+                stream = self.client.models.generate_content_stream(
+                    model=model_name,
+                    contents=self._build_prompt(diet_text),
+                    config=self._generation_config(final_instruction, model_name, timeout=timeout)
                 )
-            )
-            
-            # Prioritize structured parsing provided by SDK
-            if hasattr(response, 'parsed') and response.parsed:
-                return response.parsed
-            
-            # Fallback to text parsing
-            if hasattr(response, 'text') and response.text:
-                return self._extract_json_from_text(response.text)
-            
-            raise ValueError("Risposta vuota da Gemini")
+                for chunk in stream:
+                    if time.perf_counter() - started > timeout:
+                        stream.close()
+                        metrics.incr("gemini.diet_stream.timeouts")
+                        raise GeminiTimeoutError(f"Gemini non ha risposto entro {timeout:.0f}s.")
+                    for day in extractor.feed(getattr(chunk, 'text', None) or ""):
+                        emitted.add(diet_diff.day_key(day.get('giorno')))
+                        yield "day", day
+            except GeneratorExit:
+                # Client went away mid-stream: the upstream itself was answering
+                gemini_gateway.record("diet_stream", started)
+                raise
+            except Exception as e:
+                gemini_gateway.record("diet_stream", started, e)
+                raise
+            gemini_gateway.record("diet_stream", started)
+
+            data = self._extract_json_from_text(extractor.text)
+            # Days the incremental scan could not pick up (undecodable fragment, unexpected key order)
+            for day in data.get('piano_settimanale', []):
+                if diet_diff.day_key(day.get('giorno')) not in emitted:
+                    yield "day", day
+            yield "substitutions", data.get('tabella_sostituzioni', [])
 
         except Exception as e:
             print(f"⚠️ Errore con Gemini: {e}")
-            raise e
\ No newline at end of file
+            raise e
+
+
+class DayStreamExtractor:
+    """
+    Incremental scanner over the streamed JSON text: returns every object of the
+    `piano_settimanale` array as soon as its closing brace arrives.
+    """
+
+    ARRAY_KEY = '"piano_settimanale"'
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._state = "seek_key"  # seek_key -> seek_array -> in_array -> done
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._obj_start = None
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+    def feed(self, chunk: str) -> list:
+        self._buffer += chunk
+        days = []
+        buf = self._buffer
+
+        while self._pos < len(buf) and self._state != "done":
+            if self._state == "seek_key":
+                idx = buf.find(self.ARRAY_KEY, self._pos)
+                if idx < 0:
+                    # Keep a tail in case the key is split across chunks
+                    self._pos = max(self._pos, len(buf) - len(self.ARRAY_KEY))
+                    break
+                self._pos = idx + len(self.ARRAY_KEY)
+                self._state = "seek_array"
+                continue
+
+            ch = buf[self._pos]
+            if self._state == "seek_array":
+                if ch == "[":
+                    self._state = "in_array"
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._obj_start = self._pos
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0 and self._obj_start is not None:
+                    try:
+                        days.append(json.loads(buf[self._obj_start:self._pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._obj_start = None
+            elif ch == "]" and self._depth == 0:
+                self._state = "done"
+            self._pos += 1
+
+        return days
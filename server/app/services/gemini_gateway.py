@@ -0,0 +1,245 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+
+errors = lazy_import("google.genai.errors")
+
+
+class GeminiUnavailableError(RuntimeError):
+    """Gemini could not answer in time or is being short-circuited."""
+
+
+class CircuitOpenError(GeminiUnavailableError):
+    pass
+
+
+class GeminiTimeoutError(GeminiUnavailableError):
+    pass
+
+
+def _is_upstream_failure(exc: BaseException) -> bool:
+    # 4xx (bad request, schema...) are our fault and must not trip the breaker; 429 is load
+    if isinstance(exc, errors.APIError):
+        return exc.code == 429 or (exc.code or 0) >= 500
+    return True
+
+
+class CircuitBreaker:
+    """
+    Opens when the error rate over the last `window` calls reaches `threshold`,
+    fails fast for `cooldown` seconds, then lets a single probe through (half-open).
+    """
+
+    def __init__(self, name: str, window: int, threshold: float, min_calls: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._publish()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _publish(self) -> None:
+        metrics.set_gauge(f"{self.name}.circuit_state", self._state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = "half_open"
+                self._probe_in_flight = False
+                self._publish()
+            if self._state == "closed":
+                return True
+            if self._state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if self._state == "half_open":
+                self._state = "closed" if success else "open"
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self._outcomes.clear()
+                self._publish()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (self._state == "closed" and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.threshold):
+                self._state = "open"
+                self._opened_at = time.monotonic()
+                self._publish()
+                print(f"🔌 Gemini circuit opened ({failures}/{len(self._outcomes)} failures)")
+
+
+class GeminiGateway:
+    """
+    Wraps `client.models.generate_content` with tail-latency protection:
+    a per-call deadline, an optional hedged duplicate request once the call is
+    slower than the observed p95, a circuit breaker shared by all callers and a
+    small cache of recent responses served while the circuit is open.
+    """
+
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            "gemini",
+            window=settings.GEMINI_BREAKER_WINDOW,
+            threshold=settings.GEMINI_BREAKER_ERROR_RATE,
+            min_calls=settings.GEMINI_BREAKER_MIN_CALLS,
+            cooldown=settings.GEMINI_BREAKER_COOLDOWN_SECONDS,
+        )
+        # Calls that outlive their deadline keep running here, not in the request threadpool
+        self._executor = ThreadPoolExecutor(max_workers=settings.GEMINI_MAX_WORKERS, thread_name_prefix="gemini")
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(contents, config) -> str:
+        # Model-independent on purpose: any tier's answer is fine as an outage fallback
+        digest = hashlib.sha256()
+        digest.update(str(contents).encode("utf-8"))
+        digest.update(str(getattr(config, "system_instruction", "")).encode("utf-8"))
+        digest.update(str(getattr(config, "cached_content", "")).encode("utf-8"))
+        digest.update(str(getattr(config, "response_schema", "")).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _cache_get(self, key: str):
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+
+    def _cache_put(self, key: str, response) -> None:
+        with self._cache_lock:
+            self._cache[key] = response
+            self._cache.move_to_end(key)
+            while len(self._cache) > settings.GEMINI_RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _hedge_delay(self, operation: str) -> Optional[float]:
+        if not settings.GEMINI_HEDGE_ENABLED:
+            return None
+        name = f"gemini.{operation}.latency"
+        if metrics.count(name) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(metrics.percentile(name, 95), settings.GEMINI_HEDGE_MIN_DELAY_SECONDS)
+
+    def check(self, operation: str) -> None:
+        """Fails fast when the circuit is open (for callers that do their own I/O, e.g. streaming)."""
+        if not self.breaker.allow():
+            metrics.incr(f"gemini.{operation}.rejected")
+            raise CircuitOpenError("Gemini temporaneamente non disponibile (circuit breaker aperto).")
+
+    def record(self, operation: str, started: float, exc: Optional[BaseException] = None) -> None:
+        if exc is None:
+            metrics.observe(f"gemini.{operation}.latency", time.perf_counter() - started)
+            self.breaker.record(True)
+        else:
+            metrics.incr(f"gemini.{operation}.errors")
+            # A 4xx still proves the upstream is answering
+            self.breaker.record(not _is_upstream_failure(exc))
+
+    def call(self, fn, *, operation: str, timeout: float):
+        """Runs another Gemini API call (e.g. cache management) under the breaker and a deadline."""
+        self.check(operation)
+        started = time.perf_counter()
+        future = self._executor.submit(fn)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            metrics.incr(f"gemini.{operation}.timeouts")
+            self.record(operation, started, GeminiTimeoutError())
+            raise GeminiTimeoutError(f"Gemini non ha risposto entro {timeout:.0f}s.")
+        except Exception as e:
+            self.record(operation, started, e)
+            raise
+        self.record(operation, started)
+        return result
+
+    def generate_content(self, client, *, model: str, contents, config, operation: str, timeout: float):
+        key = self.fingerprint(contents, config)
+        try:
+            self.check(operation)
+        except CircuitOpenError:
+            cached = self._cache_get(key)
+            if cached is not None:
+                metrics.incr(f"gemini.{operation}.served_from_cache")
+                return cached
+            raise
+
+        def call():
+            return client.models.generate_content(model=model, contents=contents, config=config)
+
+        started = time.perf_counter()
+        deadline = started + timeout
+        futures = [self._executor.submit(call)]
+        hedge_delay = self._hedge_delay(operation)
+        retries_left = settings.GEMINI_MAX_RETRIES
+        last_error = None
+
+        while futures:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if hedge_delay is not None:
+                wait_for = min(remaining, max(0.0, started + hedge_delay - time.perf_counter()))
+            done, _ = wait(futures, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if hedge_delay is not None:
+                    # Slower than p95: race a duplicate request, first answer wins
+                    metrics.incr(f"gemini.{operation}.hedged")
+                    futures.append(self._executor.submit(call))
+                    hedge_delay = None
+                continue
+
+            for future in done:
+                futures.remove(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                for other in futures:
+                    other.cancel()
+                self.record(operation, started)
+                self._cache_put(key, response)
+                return response
+
+            if not futures:
+                backoff = settings.GEMINI_RETRY_BACKOFF_SECONDS
+                if retries_left and _is_upstream_failure(last_error) and deadline - time.perf_counter() > backoff:
+                    retries_left -= 1
+                    metrics.incr(f"gemini.{operation}.retried")
+                    time.sleep(backoff)
+                    futures.append(self._executor.submit(call))
+                    continue
+                self.record(operation, started, last_error)
+                raise last_error
+
+        metrics.incr(f"gemini.{operation}.timeouts")
+        self.record(operation, started, GeminiTimeoutError())
+        raise GeminiTimeoutError(f"Gemini non ha risposto entro {timeout:.0f}s.")
+
+
+gemini_gateway = GeminiGateway()
@@ -0,0 +1,78 @@
+import re
+from typing import Optional
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+# Signals that a diet carries a CAD substitution table
+SUBSTITUTION_PATTERN = re.compile(r"\bCAD\b|sostituzion|substitut|equivalenz", re.IGNORECASE)
+
+
+class ModelRouter:
+    """
+    Picks the Gemini model for a request from document features.
+
+    Rules (settings.GEMINI_ROUTING_RULES) are checked in order; the first rule
+    whose conditions all hold wins, otherwise settings.GEMINI_MODEL is used.
+    A rule may set: kind ("diet" / "receipt"), max_chars, max_pages,
+    has_substitutions, has_custom_prompt and the target model ("small",
+    "large" or a literal model name).
+    """
+
+    def __init__(self, rules: Optional[list[dict]] = None):
+        self.rules = settings.GEMINI_ROUTING_RULES if rules is None else rules
+
+    @staticmethod
+    def resolve(model: str) -> str:
+        aliases = {"small": settings.GEMINI_MODEL_SMALL, "large": settings.GEMINI_MODEL}
+        return aliases.get(model, model)
+
+    @staticmethod
+    def diet_features(text: str, page_count: int, custom_prompt: Optional[str]) -> dict:
+        return {
+            "kind": "diet",
+            "chars": len(text),
+            "pages": page_count,
+            "has_substitutions": bool(SUBSTITUTION_PATTERN.search(text)),
+            "has_custom_prompt": bool(custom_prompt),
+        }
+
+    @staticmethod
+    def receipt_features(text: str, page_count: int) -> dict:
+        return {
+            "kind": "receipt",
+            "chars": len(text),
+            "pages": page_count,
+            "has_substitutions": False,
+            "has_custom_prompt": False,
+        }
+
+    @staticmethod
+    def _matches(rule: dict, features: dict) -> bool:
+        if rule.get("kind") not in (None, "*", features["kind"]):
+            return False
+        if "max_chars" in rule and features["chars"] > rule["max_chars"]:
+            return False
+        if "max_pages" in rule and features["pages"] > rule["max_pages"]:
+            return False
+        for flag in ("has_substitutions", "has_custom_prompt"):
+            if flag in rule and features[flag] != rule[flag]:
+                return False
+        return True
+
+    def route(self, features: dict) -> str:
+        model = settings.GEMINI_MODEL
+        for rule in self.rules:
+            if self._matches(rule, features):
+                model = self.resolve(rule["model"])
+                break
+        metrics.incr(f"model_router.{features['kind']}.{model}")
+        return model
+
+    def escalation_for(self, model: str) -> Optional[str]:
+        """Model to retry with when `model` returned an invalid output, if any."""
+        target = self.resolve(settings.GEMINI_ESCALATION_MODEL or "large")
+        return target if target != model else None
+
+
+model_router = ModelRouter()
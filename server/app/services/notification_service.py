@@ -1,45 +1,193 @@
-import firebase_admin
-from firebase_admin import credentials, messaging
-import os
+import time
+import asyncio
+from typing import Optional
 
-class NotificationService:
-    _initialized = False
+from fastapi.concurrency import run_in_threadpool
 
-    def __init__(self):
-        if not NotificationService._initialized:
-            self._init_firebase()
-            NotificationService._initialized = True
+from app.core.firebase import firebase_ready
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
 
-    def _init_firebase(self):
-        # Prevent double init
-        if firebase_admin._apps:
+messaging = lazy_import("firebase_admin.messaging")
+firestore = lazy_import("firebase_admin.firestore")
+exceptions = lazy_import("firebase_admin.exceptions")
+
+
+def build_diet_ready_message(fcm_token: str) -> "messaging.Message":
+    return messaging.Message(
+        notification=messaging.Notification(
+            title="Dieta Pronta! 🥗",
+            body="Il tuo piano nutrizionale è stato elaborato."
+        ),
+        token=fcm_token,
+    )
+
+
+# Errors worth retrying vs. errors meaning the device token is dead
+# (functions so that firebase_admin.messaging is only imported once a send happens)
+def transient_errors() -> tuple:
+    return (exceptions.UnavailableError, exceptions.InternalError, exceptions.ResourceExhaustedError)
+
+def invalid_token_errors() -> tuple:
+    # Not InvalidArgumentError: FCM also returns it for malformed payloads
+    return (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+
+def register_token(uid: str, token: str) -> None:
+    """Adds a device token to users/{uid}.fcm_tokens (read by broadcasts, cleaned by prune_tokens)."""
+    if not uid or not token or not firebase_ready():
+        return
+    try:
+        firestore.client().collection('users').document(uid).set(
+            {'fcm_tokens': firestore.ArrayUnion([token])}, merge=True
+        )
+    except Exception as e:
+        print(f"⚠️ Token registration error: {e}")
+
+
+def prune_tokens(tokens: list[str]) -> None:
+    """Removes dead FCM tokens from the user documents that reference them."""
+    if not tokens or not firebase_ready():
+        return
+    db = firestore.client()
+    for token in tokens:
+        try:
+            for doc in db.collection('users').where('fcm_tokens', 'array_contains', token).stream():
+                doc.reference.update({'fcm_tokens': firestore.ArrayRemove([token])})
+        except Exception as e:
+            print(f"⚠️ Token prune error: {e}")
+
+
+class NotificationDispatcher:
+    """
+    In-process queue that takes FCM sends off the request path.
+    Pending messages are coalesced into `send_each` batches (max 500, the FCM limit),
+    transient failures are retried with exponential backoff and dead tokens are pruned.
+    """
+
+    MAX_BATCH = 500
+
+    def __init__(self, max_retries: int = 3, backoff_base: float = 1.0, coalesce_window: float = 0.2):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.coalesce_window = coalesce_window
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._sending: Optional[asyncio.Task] = None
+        # Scheduled retries: task -> (message, attempt), so stop() can flush them
+        self._retries: dict[asyncio.Task, tuple] = {}
+        self._stopping = False
+        self._invalid_tokens: set[str] = set()
+
+    def enqueue(self, message: "messaging.Message", attempt: int = 0) -> None:
+        if message.token and message.token in self._invalid_tokens:
+            metrics.incr("notifications.skipped_invalid_token")
             return
+        self._queue.put_nowait((message, attempt))
+        metrics.set_gauge("notifications.queue_depth", self._queue.qsize())
 
-        key_path = "serviceAccountKey.json"
-        if os.path.exists(key_path):
-            try:
-                cred = credentials.Certificate(key_path)
-                firebase_admin.initialize_app(cred)
-                print("🔥 Firebase Admin Initialized")
-            except Exception as e:
-                print(f"⚠️ Firebase Init Error: {e}")
-        else:
-            print("⚠️ serviceAccountKey.json not found. Notifications disabled.")
-            
-    def send_diet_ready(self, fcm_token: str) -> None:
+    def enqueue_diet_ready(self, fcm_token: str) -> None:
         if not fcm_token or not isinstance(fcm_token, str):
             print("⚠️ Skipping notification: Invalid FCM token")
             return
-        
+        self.enqueue(build_diet_ready_message(fcm_token))
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._stopping = False
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Flush whatever is pending (in-flight batch, scheduled retries, queue) before shutting down
+        if self._worker is None:
+            return
+        self._stopping = True
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        if self._sending is not None:
+            await asyncio.gather(self._sending, return_exceptions=True)
+            self._sending = None
+        for task, (message, attempt) in list(self._retries.items()):
+            task.cancel()
+            self._queue.put_nowait((message, attempt))
+        self._retries.clear()
+        # Retries during the flush are re-queued immediately and bounded by max_retries
+        while not self._queue.empty():
+            await self._send_batch(self._drain())
+
+    def _drain(self, limit: int = MAX_BATCH) -> list:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                first = await self._queue.get()
+                try:
+                    # Give concurrent requests a moment to pile up into the same batch
+                    await asyncio.sleep(self.coalesce_window)
+                except asyncio.CancelledError:
+                    self._queue.put_nowait(first)
+                    raise
+                # Shielded so that stop() can wait for an in-flight batch instead of losing it
+                self._sending = asyncio.ensure_future(self._send_batch([first] + self._drain(self.MAX_BATCH - 1)))
+                await asyncio.shield(self._sending)
+                self._sending = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Notification dispatcher error: {e}")
+
+    async def _send_batch(self, batch: list) -> None:
+        metrics.set_gauge("notifications.queue_depth", self._queue.qsize())
+        if not batch:
+            return
+        messages = [message for message, _ in batch]
+        started = time.perf_counter()
         try:
-            message = messaging.Message(
-                notification=messaging.Notification(
-                    title="Dieta Pronta! 🥗",
-                    body="Il tuo piano nutrizionale è stato elaborato."
-                ),
-                token=fcm_token,
-            )
-            response = messaging.send(message)
-            print(f"✅ Notification sent: {response}")
+            response = await run_in_threadpool(messaging.send_each, messages)
         except Exception as e:
-            print(f"⚠️ Notification Error: {e}")
\ No newline at end of file
+            # Whole-batch failure (network, auth): treat every message as transient
+            print(f"⚠️ Notification batch error: {e}")
+            for message, attempt in batch:
+                self._retry_or_drop(message, attempt)
+            return
+        finally:
+            metrics.observe("notifications.send_latency", time.perf_counter() - started)
+
+        dead_tokens = []
+        for (message, attempt), result in zip(batch, response.responses):
+            if result.success:
+                metrics.incr("notifications.sent")
+            elif isinstance(result.exception, invalid_token_errors()) and message.token:
+                dead_tokens.append(message.token)
+            elif isinstance(result.exception, transient_errors()):
+                self._retry_or_drop(message, attempt)
+            else:
+                metrics.incr("notifications.failed")
+                print(f"⚠️ Notification Error: {result.exception}")
+
+        if dead_tokens:
+            self._invalid_tokens.update(dead_tokens)
+            metrics.incr("notifications.pruned_tokens", len(dead_tokens))
+            await run_in_threadpool(prune_tokens, dead_tokens)
+        print(f"✅ Notification batch sent: {response.success_count}/{len(messages)}")
+
+    def _retry_or_drop(self, message: "messaging.Message", attempt: int) -> None:
+        if attempt >= self.max_retries:
+            metrics.incr("notifications.failed")
+            return
+        metrics.incr("notifications.retried")
+        if self._stopping:
+            self._queue.put_nowait((message, attempt + 1))
+            return
+        task = asyncio.create_task(self._retry_later(message, attempt + 1))
+        self._retries[task] = (message, attempt + 1)
+        task.add_done_callback(lambda t: self._retries.pop(t, None))
+
+    async def _retry_later(self, message: "messaging.Message", attempt: int) -> None:
+        await asyncio.sleep(self.backoff_base * (2 ** (attempt - 1)))
+        self.enqueue(message, attempt)
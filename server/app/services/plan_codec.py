@@ -0,0 +1,186 @@
+import json
+import zlib
+from collections.abc import Mapping
+from typing import Optional
+
+from app.core.config import settings
+
+# Stored under `compactPlan`; bump when the layout changes
+FORMAT_VERSION = 1
+
+# One small doc per diet_history doc, same id (see diet_summary_counts)
+DIET_SUMMARY_COLLECTION = 'diet_history_summaries'
+DIET_SUMMARY_FIELDS = {'userId', 'uploadedBy', 'uploadedAt', 'fileName', 'dayCount', 'mealCount', 'dishCount', 'substitutionCount'}
+
+
+class _Encoder:
+    def __init__(self):
+        self.strings: list[str] = []
+        self.dishes: list[dict] = []
+        self._string_ids: dict[str, int] = {}
+        self._dish_ids: dict[tuple, int] = {}
+
+    def intern(self, value) -> int:
+        value = "" if value is None else str(value)
+        index = self._string_ids.get(value)
+        if index is None:
+            index = self._string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def pairs(self, items: list) -> list[int]:
+        # Flat [name, qty, name, qty, ...]: Firestore has no nested arrays
+        flat = []
+        for item in items or []:
+            flat += [self.intern(item.get('name')), self.intern(item.get('qty'))]
+        return flat
+
+    def dish(self, dish: dict) -> int:
+        entry = {'n': self.intern(dish.get('name')), 'q': self.intern(dish.get('qty'))}
+        if dish.get('cad_code'):
+            entry['c'] = dish['cad_code']
+        if dish.get('is_composed'):
+            entry['k'] = True
+        if dish.get('ingredients'):
+            entry['i'] = self.pairs(dish['ingredients'])
+        # Identical dishes repeated across days share one entry
+        key = (entry['n'], entry['q'], entry.get('c', 0), entry.get('k', False), tuple(entry.get('i', ())))
+        index = self._dish_ids.get(key)
+        if index is None:
+            index = self._dish_ids[key] = len(self.dishes)
+            self.dishes.append(entry)
+        return index
+
+
+def encode_plan(dict_data: dict, compress: Optional[bool] = None) -> dict:
+    """
+    Encodes a DietResponse dict ({plan, substitutions}) into the compact layout:
+    s = interned strings, d = unique dishes, p = day -> meal -> dish refs,
+    x = CAD code -> group. Above COMPACT_PLAN_COMPRESS_MIN_BYTES the tables are
+    zlib-compressed into a single blob (z).
+    """
+    encoder = _Encoder()
+    plan = {
+        day: {meal: [encoder.dish(dish) for dish in dishes] for meal, dishes in (meals or {}).items()}
+        for day, meals in (dict_data.get('plan') or {}).items()
+    }
+    substitutions = {
+        code: {'n': encoder.intern(group.get('name')), 'o': encoder.pairs(group.get('options'))}
+        for code, group in (dict_data.get('substitutions') or {}).items()
+    }
+    payload = {'s': encoder.strings, 'd': encoder.dishes, 'p': plan, 'x': substitutions}
+
+    if compress is False or (compress is None and not settings.COMPACT_PLAN_COMPRESSION):
+        return {'v': FORMAT_VERSION, **payload}
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    # compress=None applies the size threshold, compress=True forces it
+    if compress or len(raw) >= settings.COMPACT_PLAN_COMPRESS_MIN_BYTES:
+        return {'v': FORMAT_VERSION, 'z': zlib.compress(raw, 9)}
+    return {'v': FORMAT_VERSION, **payload}
+
+
+class LazyPlan(Mapping):
+    """
+    Read-only day -> meal -> [dish] view over a compact plan. The blob is
+    inflated on first access and each day is rebuilt only when read.
+    """
+
+    def __init__(self, compact: dict):
+        if compact.get('v') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact plan version: {compact.get('v')}")
+        self._compact = compact
+        self._payload = None
+        self._days = {}
+        self._substitutions = None
+
+    def _tables(self) -> dict:
+        if self._payload is None:
+            blob = self._compact.get('z')
+            self._payload = json.loads(zlib.decompress(blob).decode("utf-8")) if blob is not None else self._compact
+        return self._payload
+
+    def _pairs(self, flat: list) -> list[dict]:
+        strings = self._tables()['s']
+        return [{'name': strings[flat[i]], 'qty': strings[flat[i + 1]]} for i in range(0, len(flat), 2)]
+
+    def _dish(self, index: int) -> dict:
+        tables = self._tables()
+        entry = tables['d'][index]
+        return {
+            'name': tables['s'][entry['n']],
+            'qty': tables['s'][entry['q']],
+            'cad_code': entry.get('c', 0),
+            'is_composed': entry.get('k', False),
+            'ingredients': self._pairs(entry.get('i', [])),
+        }
+
+    def __getitem__(self, day: str) -> dict:
+        if day not in self._days:
+            meals = self._tables()['p'][day]
+            self._days[day] = {meal: [self._dish(i) for i in refs] for meal, refs in meals.items()}
+        return self._days[day]
+
+    def __iter__(self):
+        return iter(self._tables()['p'])
+
+    def __len__(self) -> int:
+        return len(self._tables()['p'])
+
+    @property
+    def substitutions(self) -> dict:
+        if self._substitutions is None:
+            strings = self._tables()['s']
+            self._substitutions = {
+                code: {'name': strings[group['n']], 'options': self._pairs(group['o'])}
+                for code, group in self._tables()['x'].items()
+            }
+        return self._substitutions
+
+    def to_dict(self) -> dict:
+        return {'plan': {day: self[day] for day in self}, 'substitutions': self.substitutions}
+
+
+def decode_plan(compact: dict) -> dict:
+    return LazyPlan(compact).to_dict()
+
+
+def read_diet(doc: dict) -> dict:
+    """
+    Compatibility reader for diet documents in any storage format:
+    `compactPlan` (this module), `parsedData` (diet_history) or top-level
+    `plan`/`substitutions` (users/{uid}/diets). Compact plans come back as a LazyPlan.
+    """
+    if doc.get('compactPlan'):
+        plan = LazyPlan(doc['compactPlan'])
+        return {'plan': plan, 'substitutions': plan.substitutions}
+    data = doc.get('parsedData') or doc
+    return {'plan': data.get('plan') or {}, 'substitutions': data.get('substitutions') or {}}
+
+
+def diet_summary_counts(dict_data: dict) -> dict:
+    """Counts stored in diet_history_summaries, so list views never load the plan."""
+    plan = dict_data.get('plan') or {}
+    meals = [dishes for day in plan.values() for dishes in (day or {}).values()]
+    return {
+        'dayCount': len(plan),
+        'mealCount': len(meals),
+        'dishCount': sum(len(dishes) for dishes in meals),
+        'substitutionCount': len(dict_data.get('substitutions') or {}),
+    }
+
+
+def stored_size(value) -> int:
+    """Approximate Firestore storage size of a field value (see the Firestore storage size docs)."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, Mapping):
+        return sum(stored_size(k) + stored_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(stored_size(v) for v in value)
+    return len(str(value)) + 1
@@ -1,12 +1,30 @@
-import pytesseract
-from PIL import Image, UnidentifiedImageError
-import pdfplumber
-import os
 import json
+from typing import Optional, Union, BinaryIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import typing_extensions as typing
-from google import genai
-from google.genai import types
 from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+from app.services.model_router import model_router
+from app.services.gemini_gateway import gemini_gateway, GeminiUnavailableError
+from app.services.context_cache import context_cache, is_stale_cache_error
+from app.services.upload_service import source_size
+
+# Heavy dependencies are imported on first use (see core/lazy.py)
+pytesseract = lazy_import("pytesseract")
+Image = lazy_import("PIL.Image")
+pdfplumber = lazy_import("pdfplumber")
+fuzz = lazy_import("thefuzz.fuzz")
+process = lazy_import("thefuzz.process")
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
+errors = lazy_import("google.genai.errors")
+
+# Minimum fuzzy score for the offline matcher used when Gemini is unavailable
+FALLBACK_MATCH_SCORE = 85
+
+# Shared by all requests: caps concurrent tesseract processes per instance
+_ocr_executor = ThreadPoolExecutor(max_workers=settings.RECEIPT_OCR_WORKERS, thread_name_prefix="ocr")
 
 # --- DATA SCHEMAS ---
 class ReceiptItem(typing.TypedDict):
@@ -27,7 +45,11 @@ class ReceiptScanner:
             clean_key = api_key.strip().replace('"', '').replace("'", "")
             self.client = genai.Client(api_key=clean_key)
 
+        # Per-page extraction path of the last scanned file ("text_layer" / "ocr")
+        self.page_report = []
+
         # Optimize list for Prompt Context
+        self.allowed_foods = [str(f).lower().strip() for f in allowed_foods_list if f]
         self.allowed_foods_str = ", ".join([str(f).lower().strip() for f in allowed_foods_list if f])
         print(f"[INFO] Receipt Context: {len(allowed_foods_list)} allowed foods loaded for AI context.")
 
@@ -44,41 +66,164 @@ class ReceiptScanner:
         4. **Output Format**: Return a strictly structured JSON with a list of items.
         """
 
-    def extract_text_from_file(self, file_path):
+    def _ocr_image(self, img) -> str:
+        return pytesseract.image_to_string(img, lang='ita')
+
+    def _ocr_page(self, img) -> str:
+        # Rasterized pages are ~25 MB each at 300 DPI: free them as soon as they're read
+        try:
+            return self._ocr_image(img)
+        finally:
+            img.close()
+
+    def _extract_text_from_pdf(self, source: Union[str, BinaryIO]) -> str:
+        """
+        Hybrid extraction: pages with an embedded text layer are read directly,
+        pages without one (scans) are rasterized and sent through OCR.
+        OCR pages run concurrently on the shared OCR executor, at most
+        RECEIPT_OCR_WORKERS rasterized pages in flight per scan; the chosen
+        path is recorded in self.page_report.
+        """
+        page_texts = {}
+        pending = {}
+
+        def collect(futures) -> None:
+            for job in futures:
+                page_number = pending.pop(job)
+                try:
+                    page_texts[page_number] = job.result().strip()
+                except Exception as e:
+                    print(f"[OCR ERROR] Page {page_number}: {e}")
+                    page_texts[page_number] = ""
+                self.page_report.append({"page": page_number, "mode": "ocr", "chars": len(page_texts[page_number])})
+
+        with pdfplumber.open(source) as pdf:
+            if len(pdf.pages) > 20:
+                print("❌ PDF exceeds page limit (20)")
+                return ""
+
+            for page_number, page in enumerate(pdf.pages, start=1):
+                extracted = (page.extract_text() or "").strip()
+                if len(extracted) >= settings.RECEIPT_TEXT_LAYER_MIN_CHARS:
+                    page_texts[page_number] = extracted
+                    self.page_report.append({"page": page_number, "mode": "text_layer", "chars": len(extracted)})
+                    continue
+
+                # Bound memory: wait for a slot before rasterizing another page
+                if len(pending) >= settings.RECEIPT_OCR_WORKERS:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                # pdfplumber pages are not thread-safe: rasterize here, OCR in the pool
+                img = page.to_image(resolution=settings.RECEIPT_OCR_DPI).original
+                pending[_ocr_executor.submit(self._ocr_page, img)] = page_number
+                del img
+
+            collect(list(pending))
+
+        self.page_report.sort(key=lambda r: r["page"])
+        for r in self.page_report:
+            print(f"  📄 Page {r['page']}: {r['mode']} ({r['chars']} chars)")
+
+        return "\n".join(page_texts[n] for n in sorted(page_texts) if page_texts[n])
+
+    def extract_text_from_file(self, source: Union[str, BinaryIO], filename: Optional[str] = None):
+        """
+        `source` is a path or a seekable binary buffer; for buffers `filename`
+        tells PDFs apart from images.
+        """
         text = ""
+        self.page_report = []
+        name = filename or (source if isinstance(source, str) else "")
         try:
             # DoS Protection: Check file size (Max 10MB)
-            if os.path.getsize(file_path) > 10 * 1024 * 1024:
+            if source_size(source) > 10 * 1024 * 1024:
                 print("❌ File too large for OCR")
                 return ""
 
-            if file_path.lower().endswith('.pdf'):
-                print("  📄 Mode: Digital PDF")
-                with pdfplumber.open(file_path) as pdf:
-                    if len(pdf.pages) > 20:
-                        print("❌ PDF exceeds page limit (20)")
-                        return ""
-                    for page in pdf.pages:
-                        extracted = page.extract_text()
-                        if extracted: text += extracted + "\n"
+            if name.lower().endswith('.pdf'):
+                print("  📄 Mode: PDF (text layer / OCR per page)")
+                text = self._extract_text_from_pdf(source)
             else:
                 print("  📷 Mode: Image OCR")
-                with Image.open(file_path) as img:
+                # Decompression-bomb cap: must be in place before the first Image.open
+                Image.MAX_IMAGE_PIXELS = 20000000
+                with Image.open(source) as img:
                     img.verify()
-                with Image.open(file_path) as img:
-                    Image.MAX_IMAGE_PIXELS = 20000000
-                    text = pytesseract.image_to_string(img, lang='ita')
-        except UnidentifiedImageError:
+                if not isinstance(source, str):
+                    source.seek(0)
+                with Image.open(source) as img:
+                    text = self._ocr_image(img)
+                self.page_report.append({"page": 1, "mode": "ocr", "chars": len(text.strip())})
+        except Image.UnidentifiedImageError:
             print("[FILE ERROR] Invalid image format")
         except Exception as e:
             print(f"[FILE ERROR] {e}")
         return text
 
-    def scan_receipt(self, file_path):
-        print(f"\n--- Receipt Analysis (Gemini Powered): {file_path} ---")
+    def _generate(self, model_name: str, prompt: str, use_cache: bool = True):
+        # Static instructions are referenced from the context cache when long enough to qualify
+        cached_content = context_cache.get_or_create(self.client, model_name, self.system_instruction) if use_cache else None
+        instruction = {"cached_content": cached_content} if cached_content else {"system_instruction": self.system_instruction}
+
+        try:
+            # Deadline, retries, hedging and circuit breaker: see gemini_gateway.py
+            response = gemini_gateway.generate_content(
+                self.client,
+                model=model_name,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    **instruction,
+                    response_mime_type="application/json",
+                    response_schema=ReceiptAnalysis
+                ),
+                operation="receipt",
+                timeout=settings.GEMINI_RECEIPT_TIMEOUT_SECONDS
+            )
+        except errors.ClientError as e:
+            # Other 4xx (429, schema 400...) must not trigger a second request
+            if not cached_content or not is_stale_cache_error(e):
+                raise
+            # Cache deleted or expired server-side: forget it and resend the instructions inline
+            context_cache.invalidate(model_name, self.system_instruction)
+            return self._generate(model_name, prompt, use_cache=False)
+
+        if hasattr(response, 'parsed') and response.parsed:
+            return response.parsed
+        return None
+
+    @staticmethod
+    def _is_valid_output(data) -> bool:
+        # Structural check against ReceiptAnalysis, used to decide on model escalation
+        if data is None:
+            return False
+        items = data.get('items') if isinstance(data, dict) else getattr(data, 'items', None)
+        return isinstance(items, list)
+
+    def _local_fallback(self, full_text: str) -> list:
+        """
+        Used while Gemini is unavailable: fuzzy-matches each receipt line
+        against the allowed foods list. Lower recall, but never blocks.
+        """
+        found_items = []
+        seen = set()
+        if not self.allowed_foods:
+            return found_items
+        for line in full_text.splitlines():
+            line = line.strip().lower()
+            if len(line) < 3:
+                continue
+            match = process.extractOne(line, self.allowed_foods, scorer=fuzz.partial_ratio)
+            if match and match[1] >= FALLBACK_MATCH_SCORE and match[0] not in seen:
+                seen.add(match[0])
+                found_items.append({"name": match[0], "quantity": "", "original_scan": line})
+        print(f"[FALLBACK] Local matching found {len(found_items)} items.")
+        return found_items
+
+    def scan_receipt(self, source: Union[str, BinaryIO], filename: Optional[str] = None):
+        print(f"\n--- Receipt Analysis (Gemini Powered): {filename or source} ---")
         
         # 1. Extract Raw Text (OCR)
-        full_text = self.extract_text_from_file(file_path)
+        full_text = self.extract_text_from_file(source, filename)
         if not full_text: 
             return []
         
@@ -98,24 +243,21 @@ class ReceiptScanner:
         """
 
         try:
-            model_name = settings.GEMINI_MODEL
+            # Model picked from receipt size, see model_router.py
+            model_name = model_router.route(model_router.receipt_features(full_text, len(self.page_report)))
             print(f"🤖 Sending to Gemini ({model_name})...")
 
             # 3. Call Gemini
-            response = self.client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    system_instruction=self.system_instruction,
-                    response_mime_type="application/json",
-                    response_schema=ReceiptAnalysis
-                )
-            )
+            data = self._generate(model_name, prompt)
+            escalation = model_router.escalation_for(model_name)
+            if escalation and not self._is_valid_output(data):
+                print(f"⬆️ Invalid output from {model_name}, retrying with {escalation}")
+                metrics.incr("model_router.receipt.escalated")
+                data = self._generate(escalation, prompt)
 
             # 4. Parse Response
             found_items = []
-            if hasattr(response, 'parsed') and response.parsed:
-                data = response.parsed
+            if data:
                 # Handle both dict and object return types from SDK
                 items_list = data.get('items', []) if isinstance(data, dict) else data.items
                 
@@ -134,6 +276,10 @@ class ReceiptScanner:
             print(f"[SUCCESS] Extracted {len(found_items)} items.")
             return found_items
 
+        except GeminiUnavailableError as e:
+            print(f"⚠️ Gemini unavailable ({e}), using local fallback")
+            metrics.incr("receipt.local_fallback")
+            return self._local_fallback(full_text)
         except Exception as e:
             print(f"⚠️ Gemini Error: {e}")
-            return []
\ No newline at end of file
+            return []
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import tempfile
+from typing import Union, BinaryIO
+
+from fastapi import UploadFile, HTTPException
+
+from app.core.config import settings
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _spool_dir() -> str:
+    # Not /dev/shm by default: it is only 64 MB in a default Docker container
+    return settings.UPLOAD_SPOOL_DIR or tempfile.gettempdir()
+
+
+class SpooledUpload:
+    """
+    An uploaded file held in memory (or in a temp file under _spool_dir() once
+    it grows past UPLOAD_SPOOL_MAX_MEMORY), hashed while it was streamed in.
+    """
+
+    def __init__(self, filename: str, file: tempfile.SpooledTemporaryFile, size: int, sha256: str):
+        self.filename = filename
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+
+    def open(self) -> BinaryIO:
+        """Returns the buffer rewound to the start, ready for pdfplumber / PIL."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def spool_upload_file(file: UploadFile, max_size: int) -> SpooledUpload:
+    hasher = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_MAX_MEMORY, dir=_spool_dir())
+    size = 0
+    try:
+        while content := await file.read(CHUNK_SIZE):
+            size += len(content)
+            if size > max_size:
+                raise HTTPException(status_code=413, detail="File too large")
+            hasher.update(content)
+            spool.write(content)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return SpooledUpload(file.filename or "", spool, size, hasher.hexdigest())
+
+
+def source_size(source: Union[str, BinaryIO]) -> int:
+    """Size in bytes of a path or a seekable binary file-like object."""
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    position = source.tell()
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(position)
+    return size
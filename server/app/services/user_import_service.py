@@ -0,0 +1,196 @@
+import asyncio
+import csv
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.core.lazy import lazy_import
+from app.core.metrics import metrics
+
+auth = lazy_import("firebase_admin.auth")
+firestore = lazy_import("firebase_admin.firestore")
+
+# Firebase / Firestore limits
+IMPORT_CHUNK = 1000  # users per auth.import_users call
+LOOKUP_CHUNK = 100  # identifiers per auth.get_users call
+IN_QUERY_LIMIT = 30  # values per 'in' filter
+BATCH_LIMIT = 500  # writes per batch
+
+CSV_COLUMNS = ("email", "password", "role", "first_name", "last_name", "parent_id")
+
+
+def parse_users_csv(content: bytes) -> list[dict]:
+    """One dict per CSV row (header: CSV_COLUMNS, extra columns ignored, empty cells -> None)."""
+    reader = csv.DictReader(io.StringIO(content.decode("utf-8-sig")))
+    missing = set(CSV_COLUMNS[:5]) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"Missing CSV columns: {', '.join(sorted(missing))}")
+    return [{k: (row.get(k) or "").strip() or None for k in CSV_COLUMNS} for row in reader]
+
+
+def _hash_password(password: str) -> tuple[bytes, bytes]:
+    salt = os.urandom(16)
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, settings.USER_IMPORT_HASH_ROUNDS), salt
+
+
+def _registered_emails(emails: list[str]) -> set[str]:
+    """Lowercased emails (out of up to LOOKUP_CHUNK) that already belong to an Auth account."""
+    result = auth.get_users([auth.EmailIdentifier(email) for email in emails])
+    return {user.email.lower() for user in result.users if user.email}
+
+
+def _import_chunk(users: list[dict], hashes: list[tuple[bytes, bytes]]) -> dict[int, str]:
+    """Imports up to IMPORT_CHUNK users in one call; returns {position: reason} for rejected ones."""
+    records = [
+        auth.ImportUserRecord(
+            uid=u['uid'],
+            email=u['email'],
+            display_name=f"{u['first_name']} {u['last_name']}",
+            email_verified=True,
+            password_hash=password_hash,
+            password_salt=salt,
+            # Claims travel with the import: no set_custom_user_claims round trip per user
+            custom_claims={'role': u['role']},
+        )
+        for u, (password_hash, salt) in zip(users, hashes)
+    ]
+    result = auth.import_users(records, hash_alg=auth.UserImportHash.pbkdf2_sha256(rounds=settings.USER_IMPORT_HASH_ROUNDS))
+    return {error.index: error.reason for error in result.errors}
+
+
+def _create_one(user: dict) -> None:
+    # Same calls as /admin/create-user, used when a whole import_users call fails
+    auth.create_user(
+        uid=user['uid'],
+        email=user['email'],
+        password=user['password'],
+        display_name=f"{user['first_name']} {user['last_name']}",
+        email_verified=True
+    )
+    try:
+        auth.set_custom_user_claims(user['uid'], {'role': user['role']})
+    except Exception:
+        # An account without its role claim would pass as a row error yet still exist: remove it
+        try:
+            auth.delete_user(user['uid'])
+        except Exception as e:
+            print(f"⚠️ Rollback of {user['email']} failed ({e}), account left without role claim")
+        raise
+
+
+def _user_doc(user: dict, requester_id: str) -> dict:
+    return {
+        'uid': user['uid'],
+        'email': user['email'],
+        'role': user['role'],
+        'first_name': user['first_name'],
+        'last_name': user['last_name'],
+        'parent_id': user['parent_id'],
+        'is_active': True,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'created_by': requester_id,
+        'requires_password_change': True
+    }
+
+
+async def import_users(db, users: list[dict], requester_id: str) -> dict[int, dict]:
+    """
+    Creates Auth accounts and user documents for validated rows
+    ({index, email, password, role, first_name, last_name, parent_id}).
+    Returns {index: report line}.
+
+    import_users skips the email uniqueness check, so emails that already
+    have an Auth account are looked up first (100 per call) and rejected.
+    Accounts go through auth.import_users in chunks of 1000, with
+    pre-hashed passwords and the role claim set in the same call. If a chunk
+    call fails outright, its users are created one by one, in parallel under
+    USER_IMPORT_CONCURRENCY. Orphaned docs with the same email are then
+    removed and the new docs written, in batches of 500 ops.
+    """
+    report, total = {}, len(users)
+    semaphore = asyncio.Semaphore(settings.USER_IMPORT_CONCURRENCY)
+    for user in users:
+        user['uid'] = db.collection('users').document().id
+
+    def fail(user: dict, detail: str) -> None:
+        report[user['index']] = {"index": user['index'], "email": user['email'], "status": "error", "detail": detail}
+
+    async def limited(fn, *args):
+        async with semaphore:
+            return await run_in_threadpool(fn, *args)
+
+    async def create_fallback(user: dict):
+        try:
+            await limited(_create_one, user)
+            return user
+        except Exception as e:
+            fail(user, str(e))
+
+    # 0. Emails already registered: import_users would create a second account for them
+    emails = [u['email'] for u in users]
+    registered = set().union(*await asyncio.gather(*(
+        limited(_registered_emails, emails[i:i + LOOKUP_CHUNK]) for i in range(0, len(emails), LOOKUP_CHUNK)
+    )))
+    for user in users:
+        if user['email'].lower() in registered:
+            fail(user, "Email already registered")
+    users = [u for u in users if u['email'].lower() not in registered]
+
+    # 1. Auth accounts
+    with ThreadPoolExecutor(max_workers=settings.USER_IMPORT_CONCURRENCY) as pool:
+        hashes = await run_in_threadpool(lambda: list(pool.map(_hash_password, [u['password'] for u in users])))
+
+    created = []
+    for start in range(0, len(users), IMPORT_CHUNK):
+        chunk = users[start:start + IMPORT_CHUNK]
+        try:
+            errors = await run_in_threadpool(_import_chunk, chunk, hashes[start:start + IMPORT_CHUNK])
+        except Exception as e:
+            print(f"⚠️ import_users failed ({e}), creating {len(chunk)} users one by one")
+            metrics.incr("user_import.fallback", len(chunk))
+            created += [u for u in await asyncio.gather(*(create_fallback(u) for u in chunk)) if u]
+            continue
+        for position, user in enumerate(chunk):
+            if position in errors:
+                fail(user, errors[position])
+            else:
+                created.append(user)
+
+    # 2. Orphaned docs left behind by deleted Auth accounts with the same email
+    by_email = {u['email']: u for u in created}
+    emails = list(by_email)
+    chunks = [emails[i:i + IN_QUERY_LIMIT] for i in range(0, len(emails), IN_QUERY_LIMIT)]
+    results = await asyncio.gather(*(
+        limited(lambda c: list(db.collection('users').where('email', 'in', c).stream()), c) for c in chunks
+    ))
+    orphans = [doc.reference for docs in results for doc in docs if doc.id != by_email[doc.to_dict().get('email')]['uid']]
+
+    # 3. User docs, batched
+    writes = [(ref, None) for ref in orphans] + [
+        (db.collection('users').document(u['uid']), _user_doc(u, requester_id)) for u in created
+    ]
+    for start in range(0, len(writes), BATCH_LIMIT):
+        part = writes[start:start + BATCH_LIMIT]
+        batch = db.batch()
+        for ref, data in part:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+        try:
+            await run_in_threadpool(batch.commit)
+        except Exception as e:
+            for ref, data in part:
+                if data is not None:
+                    fail(by_email[data['email']], f"Account created, profile save failed: {e}")
+
+    for user in created:
+        if user['index'] not in report:
+            report[user['index']] = {"index": user['index'], "email": user['email'], "status": "created", "uid": user['uid']}
+    metrics.incr("user_import.created", sum(1 for r in report.values() if r['status'] == "created"))
+    print(f"👥 Imported {len(created)}/{total} users ({len(orphans)} orphaned docs removed)")
+    return report
@@ -0,0 +1,54 @@
+"""
+Writes the diet_history_summaries doc for every diet_history doc that lacks one
+(uploads made before summaries existed). Safe to re-run.
+
+Usage (from server/):
+    python -m scripts.backfill_diet_summaries [--dry-run]
+"""
+import argparse
+
+from firebase_admin import firestore
+
+from app.core.firebase import init_firebase, FIRESTORE_BATCH_LIMIT
+from app.services.plan_codec import read_diet, diet_summary_counts, DIET_SUMMARY_COLLECTION
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if not init_firebase():
+        raise SystemExit("Firebase credentials not found")
+    db = firestore.client()
+    summaries = db.collection(DIET_SUMMARY_COLLECTION)
+    existing = {ref.id for ref in summaries.list_documents()}
+
+    batch, ops, written = db.batch(), 0, 0
+    for doc in db.collection('diet_history').stream():
+        if doc.id in existing:
+            continue
+        data = doc.to_dict()
+        diet = read_diet(data)
+        summary = {
+            'userId': data.get('userId'),
+            'uploadedAt': data.get('uploadedAt'),
+            'fileName': data.get('fileName'),
+            'uploadedBy': data.get('uploadedBy'),
+            **diet_summary_counts({'plan': diet['plan'], 'substitutions': diet['substitutions']}),
+        }
+        written += 1
+        if args.dry_run:
+            continue
+        batch.set(summaries.document(doc.id), summary)
+        ops += 1
+        if ops == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch, ops = db.batch(), 0
+    if ops:
+        batch.commit()
+    print(f"{'Would write' if args.dry_run else 'Wrote'} {written} summaries ({len(existing)} already present).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compares stored sizes of parsed plans in the legacy layout (parsedData) and in
+the compact layout of app/services/plan_codec.py, and checks the round trip.
+
+Usage (from server/):
+    python -m scripts.benchmark_plan_codec plan1.json plan2.json ...
+    python -m scripts.benchmark_plan_codec --firestore 50   # latest diet_history docs
+
+JSON files may hold a DietResponse ({plan, substitutions}) or a diet_history document.
+"""
+import argparse
+import json
+import time
+
+from app.services.plan_codec import encode_plan, decode_plan, read_diet, stored_size
+
+
+def _load_files(paths):
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            doc = json.load(f)
+        yield path, doc.get('parsedData', doc)
+
+
+def _load_firestore(limit):
+    from firebase_admin import firestore
+    from app.core.firebase import init_firebase
+    if not init_firebase():
+        raise SystemExit("Firebase credentials not found")
+    query = (firestore.client().collection('diet_history')
+             .order_by('uploadedAt', direction=firestore.Query.DESCENDING).limit(limit))
+    for doc in query.stream():
+        data = read_diet(doc.to_dict())
+        yield doc.id, {'plan': dict(data['plan']), 'substitutions': data['substitutions']}
+
+
+def _plain(data):
+    return json.loads(json.dumps(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--firestore", type=int, default=0, help="benchmark the N latest diet_history docs")
+    args = parser.parse_args()
+
+    source = _load_firestore(args.firestore) if args.firestore else _load_files(args.files)
+    totals = {"legacy": 0, "compact": 0, "compressed": 0}
+    print(f"{'plan':<32}{'legacy':>10}{'compact':>10}{'zlib':>10}{'ratio':>8}{'enc ms':>8}{'dec ms':>8}")
+    for name, data in source:
+        legacy = stored_size(data)
+        started = time.perf_counter()
+        compact = encode_plan(data, compress=False)
+        compressed = encode_plan(data, compress=True)
+        encode_ms = (time.perf_counter() - started) * 1000 / 2
+        started = time.perf_counter()
+        decoded = decode_plan(compressed)
+        decode_ms = (time.perf_counter() - started) * 1000
+        if _plain(decoded) != _plain({'plan': data.get('plan') or {}, 'substitutions': data.get('substitutions') or {}}):
+            print(f"❌ {name}: round trip mismatch")
+
+        sizes = (legacy, stored_size(compact), stored_size(compressed))
+        for key, size in zip(totals, sizes):
+            totals[key] += size
+        print(f"{str(name)[:31]:<32}{sizes[0]:>10}{sizes[1]:>10}{sizes[2]:>10}"
+              f"{sizes[0] / max(1, min(sizes[1:])):>7.1f}x{encode_ms:>8.1f}{decode_ms:>8.1f}")
+
+    if totals["legacy"]:
+        best = min(totals["compact"], totals["compressed"])
+        print(f"{'TOTAL':<32}{totals['legacy']:>10}{totals['compact']:>10}{totals['compressed']:>10}"
+              f"{totals['legacy'] / max(1, best):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()